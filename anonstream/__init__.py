@@ -4,6 +4,7 @@
 import asyncio
 import json
 from collections import OrderedDict
+from math import inf
 
 from quart_compress import Compress
 
@@ -11,7 +12,9 @@ from anonstream.config import update_flask_from_toml
 from anonstream.emote import load_emote_schema
 from anonstream.quart import Quart
 from anonstream.utils.captcha import create_captcha_factory, create_captcha_signer
+from anonstream.utils.chat import ChatStore
 from anonstream.utils.user import generate_blank_allowedness
+from anonstream.utils.websocket import TOPICS
 
 __version__ = '1.6.9'
 
@@ -35,8 +38,7 @@ def create_app(toml_config):
     })
 
     # Global state: messages, users, captchas, etc.
-    app.messages_by_id = OrderedDict()
-    app.messages = app.messages_by_id.values()
+    app.messages = ChatStore(app.config['MAX_CHAT_MESSAGES'])
 
     app.users_by_token = {}
     app.users = app.users_by_token.values()
@@ -56,11 +58,50 @@ def create_app(toml_config):
 
     # State for tasks
     app.users_update_buffer = set()
+    app.messages_buffer = []  # (user, message for websocket) pairs
+
+    # Every live websocket queue, and those subscribed to each topic,
+    # mapped to their users
+    app.websocket_queues = {}
+    app.websocket_subscribers = {topic: {} for topic in TOPICS}
     app.stream_title = None
     app.stream_uptime = None
     app.stream_viewership = None
     app.last_info_task = None
 
+    # The shared part of the init payload sent to new websockets, reused
+    # until it's older than its lifetime or anything in it changes
+    app.init_snapshot = {
+        'version': 0,
+        'built_version': None,
+        'built': -inf,
+        'payload': None,
+        'text': None,
+        'packed_items': None,
+    }
+
+    # One rendition per variant stream in the master playlist, highest
+    # bandwidth first, or just one if there is no master playlist
+    app.renditions = []
+
+    # Bytes in and out of websocket compression, across all websockets
+    app.websocket_compression = {
+        'bytes_in': 0,
+        'bytes_out': 0,
+    }
+
+    # Segments read into memory, shared between every video response
+    app.segment_cache = {
+        'segments': OrderedDict(),
+        'size': 0,
+        'hits': 0,
+        'misses': 0,
+    }
+
+    # Number of responses cancelled because the client stopped reading
+    app.stalled_responses = 0
+    app.segments_condition = asyncio.Condition()
+
     # asyncio tasks to be cancelled on shutdown
     app.tasks = set()
 
@@ -81,6 +122,10 @@ def create_app(toml_config):
         import anonstream.routes
         import anonstream.tasks
 
+        # Compile the combined emote regex before the first chat message
+        from anonstream.helpers.emote import get_emotes_regex
+        get_emotes_regex()
+
         # Start control server
         if app.config['SOCKET_CONTROL_ENABLED']:
             from anonstream.control.server import start_control_server_at
@@ -1,32 +1,135 @@
 # SPDX-FileCopyrightText: 2022 n9k <https://gitler.moe/ninya9k>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import asyncio
+
 from quart import current_app
 
-from anonstream.utils.user import get_user_for_websocket
+from anonstream.utils.user import get_user_for_websocket, get_user_update_for_websocket
+from anonstream.utils.websocket import Frame, coalesce_frames, TOPIC_BY_PAYLOAD_TYPE
 
-USERS = current_app.users
+CONFIG = current_app.config
+INIT_SNAPSHOT = current_app.init_snapshot
 USERS_BY_TOKEN = current_app.users_by_token
 USERS_UPDATE_BUFFER = current_app.users_update_buffer
+MESSAGES_BUFFER = current_app.messages_buffer
+WEBSOCKET_QUEUES = current_app.websocket_queues
+WEBSOCKET_SUBSCRIBERS = current_app.websocket_subscribers
+
+def enqueue(user, queue, frame):
+    '''
+    Put `frame` in one of a user's websocket queues. If the queue is
+    full, make room according to the configured overflow policy and
+    count the frames that were dropped. Kick and close frames are never
+    dropped.
+    '''
+    try:
+        queue.put_nowait(frame)
+    except asyncio.QueueFull:
+        pass
+    else:
+        return
+
+    pending = []
+    while not queue.empty():
+        pending.append(queue.get_nowait())
+    pending.append(frame)
+    # The websocket is closed at the first kick or close frame, so if
+    # there is one then none of the other frames would be sent anyway
+    for pending_frame in pending:
+        if pending_frame.type in ('kick', 'close'):
+            kept = [pending_frame]
+            break
+    else:
+        match CONFIG['SOCKET_WEBSOCKET_OVERFLOW']:
+            case 'disconnect':
+                kept = [Frame({'type': 'close'})]
+            case 'coalesce':
+                kept = coalesce_frames(pending)
+            case 'drop-oldest':
+                kept = pending
+        kept = kept[-queue.maxsize:]
+    user['dropped_frames'] += len(pending) - len(kept)
+    for frame in kept:
+        queue.put_nowait(frame)
+
+# Payloads that change what would be in the init payload of a new websocket
+INIT_SNAPSHOT_PAYLOAD_TYPES = {
+    'info', 'message', 'messages', 'delete', 'set-users', 'rem-users',
+}
+
+def create_broadcast_frame(payload):
+    if payload['type'] in INIT_SNAPSHOT_PAYLOAD_TYPES:
+        INIT_SNAPSHOT['version'] += 1
+    return Frame(payload)
 
 def broadcast(users, payload):
+    frame = create_broadcast_frame(payload)
     for user in users:
         for queue in user['websockets']:
-            queue.put_nowait(payload)
+            enqueue(user, queue, frame)
+
+def publish(payload):
+    '''
+    Broadcast `payload` to every websocket subscribed to its topic, or to
+    every websocket if it isn't in a topic.
+    '''
+    topic = TOPIC_BY_PAYLOAD_TYPE.get(payload['type'])
+    queues = WEBSOCKET_QUEUES if topic is None else WEBSOCKET_SUBSCRIBERS[topic]
+    frame = create_broadcast_frame(payload)
+    for queue, user in queues.items():
+        enqueue(user, queue, frame)
 
 def broadcast_users_update():
     users_for_websocket = {}
     for token in USERS_UPDATE_BUFFER:
         user = USERS_BY_TOKEN[token]
-        token_hash = user['token_hash']
-        users_for_websocket[token_hash] = get_user_for_websocket(user)
+        update = get_user_update_for_websocket(user)
+        if update is not None:
+            users_for_websocket[user['token_hash']] = update
+    USERS_UPDATE_BUFFER.clear()
 
     if users_for_websocket:
-        broadcast(
-            users=USERS,
-            payload={
-                'type': 'set-users',
-                'users': users_for_websocket,
+        publish({
+            'type': 'set-users',
+            'users': users_for_websocket,
+        })
+
+def publish_chat_authors(users):
+    '''
+    Send `users` to the websockets subscribed to chat but not to users,
+    which otherwise wouldn't know who wrote the chat messages they get.
+    These websockets miss the other users updates, so every user is sent
+    in full rather than as a delta.
+    '''
+    queues = {
+        queue: user
+        for queue, user in WEBSOCKET_SUBSCRIBERS['chat'].items()
+        if queue not in WEBSOCKET_SUBSCRIBERS['users']
+    }
+    if queues:
+        frame = Frame({
+            'type': 'set-users',
+            'users': {
+                user['token_hash']: get_user_for_websocket(user)
+                for user in users
             },
-        )
-        USERS_UPDATE_BUFFER.clear()
+        })
+        for queue, user in queues.items():
+            enqueue(user, queue, frame)
+
+def broadcast_messages_buffer():
+    '''
+    Broadcast every chat message added since the last broadcast tick as
+    one frame, after one merged users update for the users who sent them.
+    '''
+    if MESSAGES_BUFFER:
+        broadcast_users_update()
+        publish_chat_authors({
+            user['token']: user for user, _ in MESSAGES_BUFFER
+        }.values())
+        publish({
+            'type': 'messages',
+            'messages': [message for _, message in MESSAGES_BUFFER],
+        })
+        MESSAGES_BUFFER.clear()
@@ -6,17 +6,17 @@ from datetime import datetime
 
 from quart import current_app, escape
 
-from anonstream.broadcast import broadcast, broadcast_users_update
+from anonstream.broadcast import publish, publish_chat_authors, broadcast_users_update
 from anonstream.events import notify_event_sockets
 from anonstream.helpers.chat import generate_nonce_hash, get_scrollback
 from anonstream.helpers.emote import insert_emotes
 from anonstream.utils.chat import get_message_for_websocket, get_approx_linespan
 
 CONFIG = current_app.config
-MESSAGES_BY_ID = current_app.messages_by_id
 MESSAGES = current_app.messages
 USERS_BY_TOKEN = current_app.users_by_token
 USERS = current_app.users
+MESSAGES_BUFFER = current_app.messages_buffer
 
 class Rejected(ValueError):
     pass
@@ -39,16 +39,7 @@ def add_chat_message(user, nonce, comment, ignore_empty=False):
     timestamp = timestamp_ms // 1000
 
     # Check user
-    while user['linespan']:
-        linespan_timestamp, _ = user['linespan'][0]
-        if timestamp - linespan_timestamp >= CONFIG['FLOOD_LINE_DURATION']:
-            user['linespan'].popleft()
-        else:
-            break
-    total_recent_linespan = sum(map(
-        lambda linespan_tuple: linespan_tuple[1],
-        user['linespan'],
-    ))
+    total_recent_linespan = user['linespan'].get_total(timestamp)
     if total_recent_linespan > CONFIG['FLOOD_LINE_THRESHOLD']:
         raise Rejected(
             f'Chat overuse in the last '
@@ -57,7 +48,7 @@ def add_chat_message(user, nonce, comment, ignore_empty=False):
 
     # Check message
     message_id = generate_nonce_hash(nonce)
-    if message_id in MESSAGES_BY_ID:
+    if message_id in MESSAGES:
         raise Rejected('Discarded suspected duplicate message')
     if len(comment) == 0:
         raise Rejected('Message was empty')
@@ -80,19 +71,13 @@ def add_chat_message(user, nonce, comment, ignore_empty=False):
         )
 
     # Record linespan
-    linespan_tuple = (timestamp, linespan)
-    user['linespan'].append(linespan_tuple)
+    user['linespan'].add(timestamp, linespan)
 
     # Create and add message
-    try:
-        last_message = next(reversed(MESSAGES))
-    except StopIteration:
+    if MESSAGES.last_seq is None or timestamp_ms > MESSAGES.last_seq:
         seq = timestamp_ms
     else:
-        if timestamp_ms > last_message['seq']:
-            seq = timestamp_ms
-        else:
-            seq = last_message['seq'] + 1
+        seq = MESSAGES.last_seq + 1
     dt = datetime.utcfromtimestamp(timestamp)
     markup = insert_emotes(escape(comment))
     message = {
@@ -106,11 +91,11 @@ def add_chat_message(user, nonce, comment, ignore_empty=False):
         'nomarkup': comment,
         'markup': markup,
     }
-    MESSAGES_BY_ID[message_id] = message
-
-    # Limit number of stored messages
-    while len(MESSAGES_BY_ID) > CONFIG['MAX_CHAT_MESSAGES']:
-        MESSAGES_BY_ID.popitem(last=False)
+    # Store the message, evicting the oldest if there are too many
+    for old_message in MESSAGES.append(message):
+        USERS_BY_TOKEN[old_message['token']]['n_messages'] -= 1
+    user['n_messages'] += 1
+    user['recent_messages'].add(timestamp)
 
     # Deverify user every n messages
     if CONFIG['CHAT_DEVERIFY_CLOCK'] is not None:
@@ -124,39 +109,31 @@ def add_chat_message(user, nonce, comment, ignore_empty=False):
         'event': message,
     })
 
-    # Broadcast a users update to all websockets,
-    # in case this message is from a new user
-    broadcast_users_update()
+    # With a broadcast tick, leave the message for the next tick to broadcast
+    if CONFIG['CHAT_BROADCAST_TICK'] is not None:
+        MESSAGES_BUFFER.append((user, get_message_for_websocket(user, message)))
+    else:
+        # Broadcast a users update to all websockets,
+        # in case this message is from a new user
+        broadcast_users_update()
+        publish_chat_authors([user])
 
-    # Broadcast message to websockets
-    broadcast(
-        USERS,
-        payload={
+        # Broadcast message to websockets
+        publish({
             'type': 'message',
             'message': get_message_for_websocket(user, message),
-        },
-    )
+        })
 
     return seq
 
 def delete_chat_messages(seqs):
-    seq_set = set(seqs)
-    message_ids = set()
-    for message_id, message in MESSAGES_BY_ID.items():
-        if len(seq_set) == 0:
-            break
-        try:
-            seq_set.remove(message['seq'])
-        except KeyError:
-            pass
-        else:
-            message_ids.add(message_id)
-    for message_id in message_ids:
-        MESSAGES_BY_ID.pop(message_id)
-    broadcast(
-        USERS,
-        payload={
-            'type': 'delete',
-            'seqs': seqs,
-        },
-    )
+    for message in MESSAGES.delete(set(seqs)):
+        USERS_BY_TOKEN[message['token']]['n_messages'] -= 1
+    MESSAGES_BUFFER[:] = [
+        (user, message) for user, message in MESSAGES_BUFFER
+        if message['seq'] not in seqs
+    ]
+    publish({
+        'type': 'delete',
+        'seqs': seqs,
+    })
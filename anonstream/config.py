@@ -30,6 +30,7 @@ def toml_to_flask_sections(config):
     TOML_TO_FLASK_SECTIONS = (
         toml_to_flask_section_socket,
         toml_to_flask_section_segments,
+        toml_to_flask_section_response,
         toml_to_flask_section_title,
         toml_to_flask_section_names,
         toml_to_flask_section_memory,
@@ -46,26 +47,54 @@ def toml_to_flask_sections(config):
 
 def toml_to_flask_section_socket(config):
     cfg = config['socket']
+    assert cfg['websocket']['queue_size'] >= 1
+    assert 0 <= cfg['websocket']['compression_level'] <= 9
+    assert cfg['websocket']['overflow'] in {
+        'drop-oldest', 'coalesce', 'disconnect',
+    }
     return {
         'SOCKET_CONTROL_ENABLED': cfg['control']['enabled'],
         'SOCKET_CONTROL_ADDRESS': cfg['control']['address'],
         'SOCKET_EVENT_ENABLED': cfg['event']['enabled'],
         'SOCKET_EVENT_ADDRESS': cfg['event']['address'],
+        'SOCKET_WEBSOCKET_QUEUE_SIZE': cfg['websocket']['queue_size'],
+        'SOCKET_WEBSOCKET_OVERFLOW': cfg['websocket']['overflow'],
+        'SOCKET_WEBSOCKET_INIT_CACHE_LIFETIME': cfg['websocket']['init_cache_lifetime'],
+        'SOCKET_WEBSOCKET_COMPRESSION': cfg['websocket']['compression'],
+        'SOCKET_WEBSOCKET_COMPRESSION_LEVEL': cfg['websocket']['compression_level'],
     }
 
 def toml_to_flask_section_segments(config):
     cfg = config['segments']
+    assert cfg['cache_bytes'] >= 0
+    assert 1 <= cfg['chunk_size'] <= cfg['max_chunk_size']
     return {
         'SEGMENT_DIRECTORY': os.path.realpath(cfg['directory']),
         'SEGMENT_PLAYLIST': os.path.join(
             os.path.realpath(cfg['directory']),
             cfg['playlist'],
         ),
+        'SEGMENT_MASTER_PLAYLIST': (
+            os.path.join(
+                os.path.realpath(cfg['directory']),
+                cfg['master_playlist'],
+            )
+            if cfg['master_playlist'] else None
+        ),
         'SEGMENT_PLAYLIST_CACHE_LIFETIME': cfg['playlist_cache_lifetime'],
         'SEGMENT_PLAYLIST_STALE_THRESHOLD': cfg['playlist_stale_threshold'],
-        'SEGMENT_SEARCH_COOLDOWN': cfg['search_cooldown'],
         'SEGMENT_SEARCH_TIMEOUT': cfg['search_timeout'],
         'SEGMENT_STREAM_INITIAL_BUFFER': cfg['stream_initial_buffer'],
+        'SEGMENT_CACHE_BYTES': cfg['cache_bytes'],
+        'SEGMENT_CHUNK_SIZE': cfg['chunk_size'],
+        'SEGMENT_MAX_CHUNK_SIZE': cfg['max_chunk_size'],
+    }
+
+def toml_to_flask_section_response(config):
+    cfg = config['response']
+    assert cfg['send_timeout'] > 0
+    return {
+        'RESPONSE_SEND_TIMEOUT': cfg['send_timeout'],
     }
 
 def toml_to_flask_section_title(config):
@@ -121,6 +150,7 @@ def toml_to_flask_section_presence(config):
 def toml_to_flask_section_chat(config):
     cfg = config['chat']
     assert cfg['force_captcha_every'] >= 0
+    assert cfg['broadcast_tick'] >= 0
     return {
         'CHAT_COMMENT_MAX_LENGTH': cfg['max_comment_length'],
         'CHAT_COMMENT_MAX_LINES': cfg['max_comment_lines'],
@@ -130,16 +160,21 @@ def toml_to_flask_section_chat(config):
         'CHAT_TRIPCODE_PASSWORD_MAX_LENGTH': cfg['max_tripcode_password_length'],
         'CHAT_LEGACY_TRIPCODE_ALGORITHM': cfg['legacy_tripcode_algorithm'],
         'CHAT_DEVERIFY_CLOCK': cfg['force_captcha_every'] or None,
+        'CHAT_BROADCAST_TICK': cfg['broadcast_tick'] or None,
     }
 
 def toml_to_flask_section_flood(config):
     cfg = config['flood']
     assert cfg['video']['max_eyes'] >= 0
+    assert cfg['messages']['mode'] in {'window', 'bucket'}
+    assert cfg['lines']['mode'] in {'window', 'bucket'}
     return {
         'FLOOD_MESSAGE_DURATION': cfg['messages']['duration'],
         'FLOOD_MESSAGE_THRESHOLD': cfg['messages']['threshold'],
+        'FLOOD_MESSAGE_MODE': cfg['messages']['mode'],
         'FLOOD_LINE_DURATION': cfg['lines']['duration'],
         'FLOOD_LINE_THRESHOLD': cfg['lines']['threshold'],
+        'FLOOD_LINE_MODE': cfg['lines']['mode'],
         'FLOOD_VIDEO_MAX_EYES': cfg['video']['max_eyes'],
         'FLOOD_VIDEO_COOLDOWN': cfg['video']['cooldown'],
         'FLOOD_VIDEO_EYES_EXPIRE_AFTER': cfg['video']['expire_after'],
@@ -9,6 +9,7 @@ from anonstream.control.spec.methods.config import SPEC as SPEC_CONFIG
 from anonstream.control.spec.methods.emote import SPEC as SPEC_EMOTE
 from anonstream.control.spec.methods.help import SPEC as SPEC_HELP
 from anonstream.control.spec.methods.quit import SPEC as SPEC_QUIT
+from anonstream.control.spec.methods.stream import SPEC as SPEC_STREAM
 from anonstream.control.spec.methods.title import SPEC as SPEC_TITLE
 from anonstream.control.spec.methods.tripcode import SPEC as SPEC_TRIPCODE
 from anonstream.control.spec.methods.user import SPEC as SPEC_USER
@@ -17,6 +18,7 @@ SPEC = Str({
     'help': SPEC_HELP,
     'quit': SPEC_QUIT,
     'title': SPEC_TITLE,
+    'stream': SPEC_STREAM,
     'chat': SPEC_CHAT,
     'user': SPEC_USER,
     'allowednesss': SPEC_ALLOWEDNESS,
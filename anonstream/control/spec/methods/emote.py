@@ -6,7 +6,7 @@ import json
 from quart import current_app
 
 from anonstream.emote import load_emote_schema_async, BadEmote
-from anonstream.helpers.emote import get_emote_markup
+from anonstream.helpers.emote import get_emote_markup, get_emotes_regex
 from anonstream.control.spec.common import Str, End
 from anonstream.control.exceptions import CommandFailed
 
@@ -48,6 +48,9 @@ async def cmd_emote_reload():
             EMOTES.append(emote)
         # Clear emote markup cache -- emotes by the same name may have changed
         get_emote_markup.cache_clear()
+        # Recompile the combined emote regex now rather than on the next message
+        get_emotes_regex.cache_clear()
+        get_emotes_regex()
     normal = ['emote', 'reload']
     response = ''
     return normal, response
@@ -12,6 +12,7 @@ async def cmd_help():
         ' quit...........................close the control connection\n'
         ' title [show]...................show the stream title\n'
         ' title set TITLE................set the stream title\n'
+        ' stream stats...................show video/websocket measurements\n'
         ' user [show]....................show a list of users\n'
         ' user attr USER.................set an attribute of a user\n'
         ' user get USER ATTR.............set an attribute of a user\n'
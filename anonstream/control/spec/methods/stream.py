@@ -0,0 +1,81 @@
+# SPDX-FileCopyrightText: 2022 n9k <https://gitler.moe/ninya9k>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import json
+
+from quart import current_app
+
+from anonstream.control.spec.common import Str, End
+
+USERS = current_app.users
+RENDITIONS = current_app.renditions
+SEGMENT_CACHE = current_app.segment_cache
+WEBSOCKET_COMPRESSION = current_app.websocket_compression
+
+async def cmd_stream_help():
+    normal = ['stream', 'help']
+    response = (
+        'Usage: stream stats\n'
+        'Commands:\n'
+        ' stream stats.......show measurements of video responses and websockets\n'
+    )
+    return normal, response
+
+async def cmd_stream_stats():
+    all_eyes = [
+        eyes
+        for user in USERS
+        for eyes in user['eyes']['current'].values()
+    ]
+    bytes_sent = sum(eyes['bytes_sent'] for eyes in all_eyes)
+    send_time = sum(eyes['send_time'] for eyes in all_eyes)
+    segments_behind = [
+        eyes['segments_behind']
+        for eyes in all_eyes
+        if eyes['segments_behind'] is not None
+    ]
+    stats = {
+        'eyes': len(all_eyes),
+        'bytes_sent': bytes_sent,
+        'send_time': send_time,
+        'throughput': bytes_sent / send_time if send_time > 0 else None,
+        'segments_behind': {
+            'mean': (
+                sum(segments_behind) / len(segments_behind)
+                if segments_behind else None
+            ),
+            'max': max(segments_behind, default=None),
+        },
+        'stalls': sum(eyes['stalls'] for eyes in all_eyes),
+        'stalled_responses': current_app.stalled_responses,
+        'renditions': {
+            rendition['name']: sum(
+                eyes['rendition'] == rendition['name'] for eyes in all_eyes
+            )
+            for rendition in RENDITIONS
+        },
+        'segment_cache': {
+            'segments': len(SEGMENT_CACHE['segments']),
+            'size': SEGMENT_CACHE['size'],
+            'hits': SEGMENT_CACHE['hits'],
+            'misses': SEGMENT_CACHE['misses'],
+        },
+        'websocket_compression': {
+            'bytes_in': WEBSOCKET_COMPRESSION['bytes_in'],
+            'bytes_out': WEBSOCKET_COMPRESSION['bytes_out'],
+            'ratio': (
+                WEBSOCKET_COMPRESSION['bytes_in']
+                / WEBSOCKET_COMPRESSION['bytes_out']
+                if WEBSOCKET_COMPRESSION['bytes_out'] > 0 else None
+            ),
+        },
+    }
+    normal = ['stream', 'stats']
+    response = json.dumps(stats) + '\n'
+    return normal, response
+
+SPEC = Str({
+    None: End(cmd_stream_stats),
+    'help': End(cmd_stream_help),
+    'stats': End(cmd_stream_stats),
+})
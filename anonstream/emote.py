@@ -53,3 +53,14 @@ def precompute_emote_regex(schema):
         emote['regex'] = re.compile(''.join(
             (onset, re.escape(escape(emote['name'])), finish)
         ))
+
+def compile_emotes_regex(schema):
+    '''
+    Combine the regexes of the emotes in `schema` into one regex that
+    finds any of them, so a message can be searched for every emote in a
+    single pass. At the same position, emotes earlier in the schema take
+    precedence. None if there are no emotes.
+    '''
+    if not schema:
+        return None
+    return re.compile('|'.join(emote['regex'].pattern for emote in schema))
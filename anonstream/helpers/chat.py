@@ -12,7 +12,4 @@ def generate_nonce_hash(nonce):
     return hashlib.sha256(parts).hexdigest()
 
 def get_scrollback(messages):
-    n = CONFIG['MAX_CHAT_SCROLLBACK']
-    if len(messages) < n:
-        return messages
-    return list(messages)[-n:]
+    return messages.get_last(CONFIG['MAX_CHAT_SCROLLBACK'])
@@ -3,6 +3,8 @@ from functools import lru_cache
 
 from quart import current_app, escape, url_for, Markup
 
+from anonstream.emote import compile_emotes_regex
+
 EMOTES = current_app.emotes
 
 @lru_cache
@@ -17,11 +19,25 @@ def get_emote_markup(emote_name, emote_file, emote_width, emote_height):
         f'''alt="{emote_name_markup}" title="{emote_name_markup}">'''
     )
 
+@lru_cache(maxsize=1)
+def get_emotes_regex():
+    '''
+    Return the combined regex of the current emotes, and the emote each
+    matched string stands for. Cleared whenever the emotes are reloaded.
+    '''
+    emotes_by_match = {}
+    for emote in EMOTES:
+        emotes_by_match.setdefault(str(escape(emote['name'])), emote)
+    return compile_emotes_regex(EMOTES), emotes_by_match
+
 def insert_emotes(markup):
     assert isinstance(markup, markupsafe.Markup)
-    for emote in EMOTES:
-        emote_markup = get_emote_markup(
+    regex, emotes_by_match = get_emotes_regex()
+    if regex is None:
+        return markup
+    def replace(match):
+        emote = emotes_by_match[match.group()]
+        return get_emote_markup(
             emote['name'], emote['file'], emote['width'], emote['height'],
         )
-        markup = emote['regex'].sub(emote_markup, markup)
-    return Markup(markup)
+    return Markup(regex.sub(replace, markup))
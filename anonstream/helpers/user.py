@@ -3,12 +3,13 @@
 
 import hashlib
 import base64
-from collections import deque, OrderedDict
+from collections import OrderedDict
 from math import inf
 
 from quart import current_app
 
 from anonstream.utils.colour import generate_colour, colour_to_color
+from anonstream.utils.ratelimit import create_ratelimit
 from anonstream.utils.user import Presence
 
 CONFIG = current_app.config
@@ -39,6 +40,9 @@ def generate_user(
         'broadcaster': broadcaster,
         'verified': verified or broadcaster,
         'websockets': {},
+        'dropped_frames': 0,
+        'update_version': 0,
+        'update_fields': None,
         'name': None,
         'color': colour_to_color(colour),
         'tripcode': None,
@@ -51,11 +55,22 @@ def generate_user(
             'allowed': -inf,
         },
         'presence': presence,
-        'linespan': deque(),
+        'linespan': create_ratelimit(
+            CONFIG['FLOOD_LINE_MODE'],
+            CONFIG['FLOOD_LINE_DURATION'],
+            CONFIG['FLOOD_LINE_THRESHOLD'],
+        ),
+        'n_messages': 0,
+        'recent_messages': create_ratelimit(
+            CONFIG['FLOOD_MESSAGE_MODE'],
+            CONFIG['FLOOD_MESSAGE_DURATION'],
+            CONFIG['FLOOD_MESSAGE_THRESHOLD'],
+        ),
         'eyes': {
             'total': 0,
             'current': {},
         },
+        'rendition': None,
         'headers': headers,
         'clock': 0,
     }
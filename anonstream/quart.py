@@ -5,6 +5,7 @@
 # version.
 
 import asyncio
+import time
 
 from werkzeug.wrappers import Response as WerkzeugResponse
 from quart.app import Quart as Quart_
@@ -12,7 +13,21 @@ from quart.asgi import ASGIHTTPConnection as ASGIHTTPConnection_
 from quart.utils import encode_headers
 
 
-RESPONSE_ITERATOR_TIMEOUT = 10.0
+RESPONSE_FILE_CHUNK_SIZE = 65536
+ZEROCOPYSEND = 'http.response.zerocopysend'
+
+
+class FileBody:
+    '''
+    Yield one of these from a streaming response body to send the whole
+    of the file `fp` (opened in binary mode).  If the ASGI server has the
+    zero-copy send extension, the server sends the file itself without it
+    ever being read into Python; otherwise the file is read and sent in
+    chunks of `chunk_size` bytes.  Either way the file is closed afterwards.
+    '''
+    def __init__(self, fp, chunk_size=RESPONSE_FILE_CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
 
 
 class ASGIHTTPConnection(ASGIHTTPConnection_):
@@ -23,35 +38,85 @@ class ASGIHTTPConnection(ASGIHTTPConnection_):
             "headers": encode_headers(response.headers),
         })
 
-        if isinstance(response, WerkzeugResponse):
-            for data in response.response:
-                body = data.encode(response.charset) if isinstance(data, str) else data
-                await asyncio.wait_for(
-                    send({
-                        "type": "http.response.body",
-                        "body": body,
-                        "more_body": True,
-                    }),
-                    timeout=RESPONSE_ITERATOR_TIMEOUT,
-                )
-        else:
-            async with response.response as response_body:
-                async for data in response_body:
-                    body = data.encode(response.charset) if isinstance(data, str) else data
-                    await asyncio.wait_for(
-                        send({
-                            "type": "http.response.body",
-                            "body": body,
-                            "more_body": True,
-                        }),
-                        timeout=RESPONSE_ITERATOR_TIMEOUT,
-                    )
+        # Instead of giving every chunk of the body its own timeout, one
+        # watchdog per response cancels the response if a single send
+        # takes too long (i.e. the client has stopped reading).
+        self._sending_since = None
+        self._stalled = False
+        timeout = self.app.config['RESPONSE_SEND_TIMEOUT']
+        watchdog = asyncio.create_task(
+            self._watchdog(asyncio.current_task(), timeout)
+        )
+        try:
+            if isinstance(response, WerkzeugResponse):
+                for data in response.response:
+                    await self._send_data(send, response, data)
+            else:
+                async with response.response as response_body:
+                    async for data in response_body:
+                        await self._send_data(send, response, data)
+        except asyncio.CancelledError as e:
+            if not self._stalled:
+                raise
+            task = asyncio.current_task()
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            self.app.stalled_responses += 1
+            raise asyncio.TimeoutError(
+                f'client did not read the response for {timeout}s'
+            ) from e
+        finally:
+            watchdog.cancel()
+
         await send({
             "type": "http.response.body",
             "body": b"",
             "more_body": False,
         })
 
+    async def _watchdog(self, task, timeout):
+        while True:
+            if self._sending_since is None:
+                await asyncio.sleep(timeout)
+            else:
+                sending_for = time.monotonic() - self._sending_since
+                if sending_for >= timeout:
+                    self._stalled = True
+                    task.cancel()
+                    break
+                await asyncio.sleep(timeout - sending_for)
+
+    async def _send_data(self, send, response, data):
+        if isinstance(data, FileBody):
+            with data.fp as fp:
+                if ZEROCOPYSEND in self.scope.get("extensions", {}):
+                    await self._send_watched(send, {
+                        "type": ZEROCOPYSEND,
+                        "file": fp,
+                        "more_body": True,
+                    })
+                else:
+                    loop = asyncio.get_running_loop()
+                    while body := await loop.run_in_executor(
+                        None, fp.read, data.chunk_size,
+                    ):
+                        await self._send_body(send, body)
+        else:
+            body = data.encode(response.charset) if isinstance(data, str) else data
+            await self._send_body(send, body)
+
+    async def _send_body(self, send, body):
+        await self._send_watched(send, {
+            "type": "http.response.body",
+            "body": body,
+            "more_body": True,
+        })
+
+    async def _send_watched(self, send, message):
+        self._sending_since = time.monotonic()
+        await send(message)
+        self._sending_since = None
+
 
 class Quart(Quart_):
     asgi_http_class = ASGIHTTPConnection
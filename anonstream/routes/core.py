@@ -12,7 +12,7 @@ from anonstream.access import add_failure, pop_failure
 from anonstream.captcha import get_captcha_image, get_random_captcha_digest
 from anonstream.segments import segments, StopSendingSegments
 from anonstream.stream import is_online, get_stream_uptime
-from anonstream.user import watching, create_eyes, renew_eyes, EyesException, RatelimitedEyes, TooManyEyes, ensure_allowedness, Blacklisted, SecretClub
+from anonstream.user import watching, create_eyes, renew_eyes, record_eyes_send, downgrade_eyes, EyesException, RatelimitedEyes, TooManyEyes, ensure_allowedness, Blacklisted, SecretClub
 from anonstream.routes.wrappers import with_user_from, auth_required, generate_and_add_user, clean_cache_headers, etag_conditional
 from anonstream.helpers.captcha import check_captcha_digest, Answer
 from anonstream.utils.security import generate_csp
@@ -94,7 +94,17 @@ async def stream(timestamp, user):
                 else:
                     user['last']['watching'] = timestamp
                 print(f'{uri}: \033[37m{eyes_id}\033[0m~{identifying_string(user)}')
-            generator = segments(segment_read_hook, token=f'\033[35m{user["token"]}\033[0m')
+            def segment_sent_hook(uri, **stats):
+                record_eyes_send(user, eyes_id, **stats)
+            def downgrade_hook(rendition_name):
+                downgrade_eyes(user, eyes_id, rendition_name)
+            generator = segments(
+                segment_read_hook,
+                segment_sent_hook,
+                downgrade_hook,
+                token=f'\033[35m{user["token"]}\033[0m',
+                rendition_name=request.args.get('rendition', user['rendition']),
+            )
             response = await make_response(generator)
             response.headers['Content-Type'] = 'video/mp4'
             response.timeout = None
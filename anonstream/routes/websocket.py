@@ -7,10 +7,20 @@ from quart import current_app, websocket
 from anonstream.user import see, ensure_allowedness, AllowednessException
 from anonstream.websocket import websocket_outbound, websocket_inbound
 from anonstream.routes.wrappers import with_user_from
+from anonstream.utils.websocket import choose_websocket_protocol, parse_topics
+
+CONFIG = current_app.config
+WEBSOCKET_QUEUES = current_app.websocket_queues
+WEBSOCKET_SUBSCRIBERS = current_app.websocket_subscribers
 
 @current_app.websocket('/live')
 @with_user_from(websocket, fallback_to_token=True, ignore_allowedness=True)
 async def live(timestamp, user_or_token):
+    protocol, binary, deflate = choose_websocket_protocol(
+        websocket.requested_subprotocols,
+        allow_deflate=CONFIG['SOCKET_WEBSOCKET_COMPRESSION'],
+    )
+    await websocket.accept(subprotocol=protocol)
     match user_or_token:
         case str() | None:
             await websocket.send_json({'type': 'kick'})
@@ -22,14 +32,28 @@ async def live(timestamp, user_or_token):
                 await websocket.send_json({'type': 'kick'})
                 await websocket.close(1001)
             else:
-                queue = asyncio.Queue()
+                queue = asyncio.Queue(
+                    maxsize=CONFIG['SOCKET_WEBSOCKET_QUEUE_SIZE'],
+                )
                 user['websockets'][queue] = timestamp
                 user['last']['reading'] = timestamp
+                WEBSOCKET_QUEUES[queue] = user
+                topics = parse_topics(websocket.args.get('topics'))
+                for topic in topics:
+                    WEBSOCKET_SUBSCRIBERS[topic][queue] = user
 
-                producer = websocket_outbound(queue, user)
+                producer = websocket_outbound(
+                    queue,
+                    user,
+                    binary=binary,
+                    deflate=deflate,
+                )
                 consumer = websocket_inbound(queue, user)
                 try:
                     await asyncio.gather(producer, consumer)
                 finally:
                     see(user)
                     user['websockets'].pop(queue)
+                    WEBSOCKET_QUEUES.pop(queue)
+                    for topic in topics:
+                        WEBSOCKET_SUBSCRIBERS[topic].pop(queue)
@@ -3,15 +3,40 @@
 
 import asyncio
 import os
+import re
 import time
+from collections import namedtuple
 
 import aiofiles
-import m3u8
 from quart import current_app
 
-from anonstream.wrappers import ttl_cache
+from anonstream.quart import FileBody
+from anonstream.utils.inotify import inotify_init, inotify_watch_directory, read_inotify_events, InotifyUnavailable
 
 CONFIG = current_app.config
+RENDITIONS = current_app.renditions
+SEGMENT_CACHE = current_app.segment_cache
+SEGMENTS_CONDITION = current_app.segments_condition
+
+CHUNK_SIZE_GROW_THRESHOLD = 0.01
+CHUNK_SIZE_SHRINK_THRESHOLD = 1.0
+
+# Switch to a lower rendition if a segment was sent any slower than this
+# many times faster than its own bitrate
+RENDITION_DOWNGRADE_HEADROOM = 1.25
+
+RE_MAP_URI = re.compile(r'URI="(?P<uri>[^"]*)"')
+RE_BANDWIDTH = re.compile(r'(?:^|,)BANDWIDTH=(?P<bandwidth>[0-9]+)')
+
+InitSection = namedtuple('InitSection', ('uri',))
+Segment = namedtuple('Segment', ('uri', 'duration', 'init_section'))
+
+class Playlist:
+    def __init__(self):
+        self.media_sequence = 0
+        self.target_duration = None
+        self.is_endlist = False
+        self.segments = []
 
 class Offline(Exception):
     pass
@@ -25,9 +50,89 @@ class UnsafePath(Exception):
 class StopSendingSegments(Exception):
     pass
 
-def get_mtime():
+def generate_rendition(name, bandwidth, playlist_path):
+    return {
+        'name': name,
+        'bandwidth': bandwidth,
+        'directory': os.path.dirname(playlist_path),
+        'playlist_path': playlist_path,
+        'playlist': None,
+        'mtime': None,
+        'media_sequence': None,
+        'index_by_uri': {},
+        'cached_keys': set(),
+        'offline': 'playlist has not been loaded yet',
+    }
+
+def parse_master_playlist(text):
+    '''
+    Return a (bandwidth, uri) pair for each variant stream listed in an
+    HLS master playlist. The bandwidth is None if it isn't given.
+    '''
+    variants = []
+    stream_inf = None
+    for line in text.splitlines():
+        if not line:
+            continue
+        elif line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = line.removeprefix('#EXT-X-STREAM-INF:')
+        elif not line.startswith('#') and stream_inf is not None:
+            match = RE_BANDWIDTH.search(stream_inf)
+            bandwidth = None if match is None else int(match.group('bandwidth'))
+            variants.append((bandwidth, line))
+            stream_inf = None
+    return variants
+
+def load_renditions():
+    '''
+    Read the master playlist and return one rendition for each of its
+    variant streams, highest bandwidth first.
+    '''
+    with open(CONFIG['SEGMENT_MASTER_PLAYLIST']) as fp:
+        text = fp.read()
+    renditions = []
+    for bandwidth, uri in parse_master_playlist(text):
+        playlist_path = os.path.realpath(
+            os.path.join(CONFIG['SEGMENT_DIRECTORY'], uri)
+        )
+        directory = os.path.commonpath(
+            (playlist_path, CONFIG['SEGMENT_DIRECTORY'])
+        )
+        if directory != CONFIG['SEGMENT_DIRECTORY']:
+            raise UnsafePath(playlist_path)
+        name = os.path.dirname(uri) or os.path.splitext(uri)[0]
+        renditions.append(generate_rendition(name, bandwidth, playlist_path))
+    renditions.sort(
+        key=lambda rendition: rendition['bandwidth'] or 0,
+        reverse=True,
+    )
+    return renditions
+
+def choose_rendition(name=None):
+    '''
+    Return the rendition called `name`, or the highest rendition if there
+    is no such rendition.
+    '''
+    if not RENDITIONS:
+        raise Offline('renditions have not been loaded yet')
+    for rendition in RENDITIONS:
+        if rendition['name'] == name:
+            break
+    else:
+        rendition = RENDITIONS[0]
+    return rendition
+
+def get_lower_rendition(rendition):
+    '''
+    Return the rendition one step below `rendition`, or None if it is
+    already the lowest.
+    '''
+    index = RENDITIONS.index(rendition) + 1
+    return RENDITIONS[index] if index < len(RENDITIONS) else None
+
+def get_mtime(rendition):
     try:
-        mtime = os.path.getmtime(CONFIG['SEGMENT_PLAYLIST'])
+        mtime = os.path.getmtime(rendition['playlist_path'])
     except OSError as e:
         raise Stale(f"couldn't stat playlist: {e}") from e
     else:
@@ -36,19 +141,75 @@ def get_mtime():
             raise Stale(f'last modified {mtime_ago:.1f}s ago')
     return mtime
 
-@ttl_cache(CONFIG['SEGMENT_PLAYLIST_CACHE_LIFETIME'])
-def get_playlist():
-    #print(f'[debug @ {time.time():.3f}] get_playlist()')
+def parse_playlist(text, previous=None):
+    '''
+    Parse an HLS media playlist. ffmpeg rewrites the playlist by dropping
+    segments from the start and appending segments to the end, so most
+    segments will have been in the `previous` playlist too. Those are
+    reused as they are; only the #EXTINF entries of new segments are
+    actually parsed.
+    '''
+    playlist = Playlist()
+    init_section = None
+    extinf = None
+    for line in text.splitlines():
+        if not line:
+            continue
+        elif not line.startswith('#'):
+            sequence = playlist.media_sequence + len(playlist.segments)
+            index = (
+                None if previous is None else
+                sequence - previous.media_sequence
+            )
+            if (
+                index is not None
+                and 0 <= index < len(previous.segments)
+                and previous.segments[index].uri == line
+                and previous.segments[index].init_section == init_section
+            ):
+                segment = previous.segments[index]
+            else:
+                duration, _, _ = (extinf or '').partition(',')
+                segment = Segment(
+                    uri=line,
+                    duration=float(duration or 0),
+                    init_section=init_section,
+                )
+            playlist.segments.append(segment)
+            extinf = None
+        else:
+            tag, _, value = line.partition(':')
+            match tag:
+                case '#EXTINF':
+                    extinf = value
+                case '#EXT-X-MEDIA-SEQUENCE':
+                    playlist.media_sequence = int(value)
+                case '#EXT-X-TARGETDURATION':
+                    playlist.target_duration = float(value)
+                case '#EXT-X-MAP':
+                    if match := RE_MAP_URI.search(value):
+                        init_section = InitSection(uri=match.group('uri'))
+                case '#EXT-X-ENDLIST':
+                    playlist.is_endlist = True
+    return playlist
+
+def load_playlist(rendition):
+    #print(f'[debug @ {time.time():.3f}] load_playlist({rendition["name"]!r})')
     try:
-        mtime = get_mtime()
+        mtime = get_mtime(rendition)
     except Stale as e:
         reason, *_ = e.args
         raise Offline(f'stale playlist: {reason}') from e
     else:
         try:
-            playlist = m3u8._load_from_file(CONFIG['SEGMENT_PLAYLIST'])
-        except OSError:
+            with open(rendition['playlist_path']) as fp:
+                text = fp.read()
+        except OSError as e:
             raise Offline(f"couldn't read playlist: {e}") from e
+        try:
+            playlist = parse_playlist(text, previous=rendition['playlist'])
+        except ValueError as e:
+            raise Offline(f"couldn't parse playlist: {e}") from e
         else:
             if playlist.is_endlist:
                 raise Offline('playlist ended')
@@ -57,37 +218,190 @@ def get_playlist():
 
     return playlist, mtime
 
-def get_starting_segment():
+def get_playlist(rendition=None):
+    '''
+    Return the most recently loaded playlist of `rendition` (by default
+    the highest rendition). Playlists are only ever loaded by the
+    playlist watchers, so calling this is cheap.
+    '''
+    if rendition is None:
+        rendition = choose_rendition()
+    if rendition['offline'] is not None:
+        raise Offline(rendition['offline'])
+    mtime_ago = time.time() - rendition['mtime']
+    if mtime_ago >= CONFIG['SEGMENT_PLAYLIST_STALE_THRESHOLD']:
+        raise Offline(f'stale playlist: last modified {mtime_ago:.1f}s ago')
+    return rendition['playlist'], rendition['mtime']
+
+async def refresh_playlist(rendition):
+    '''
+    Load the playlist and read its new segments into the segment cache
+    before publishing it, so that by the time anyone learns about a
+    segment it is already in memory. Then wake up every segment
+    generator waiting on a new segment.
+    '''
+    try:
+        playlist, mtime = load_playlist(rendition)
+    except Offline as e:
+        reason, *_ = e.args
+        rendition['offline'] = reason
+        playlist = None
+    else:
+        await cache_new_segments(rendition, playlist)
+        rendition['playlist'], rendition['mtime'] = playlist, mtime
+        rendition['media_sequence'] = playlist.media_sequence or 0
+        rendition['index_by_uri'] = {
+            segment.uri: index
+            for index, segment in enumerate(playlist.segments)
+        }
+        rendition['offline'] = None
+    evict_old_segments(rendition, playlist)
+    async with SEGMENTS_CONDITION:
+        SEGMENTS_CONDITION.notify_all()
+
+async def watch_renditions():
+    '''
+    Load the renditions, then watch each of their playlists. Without a
+    master playlist there is only one rendition: the configured playlist.
+    '''
+    if CONFIG['SEGMENT_MASTER_PLAYLIST'] is None:
+        renditions = [
+            generate_rendition(None, None, CONFIG['SEGMENT_PLAYLIST']),
+        ]
+    else:
+        while True:
+            try:
+                renditions = load_renditions()
+            except (OSError, ValueError, UnsafePath) as e:
+                print(
+                    f'[debug @ {time.time():.3f}] '
+                    f'could not load master playlist: {e!r}'
+                )
+            else:
+                if renditions:
+                    break
+            await asyncio.sleep(CONFIG['SEGMENT_PLAYLIST_STALE_THRESHOLD'])
+    RENDITIONS.extend(renditions)
+    await asyncio.gather(*map(watch_playlist, RENDITIONS))
+
+async def watch_playlist(rendition):
+    '''
+    Refresh a rendition's playlist every time ffmpeg writes it. If
+    inotify is unavailable, fall back to polling the playlist's mtime.
+    The directory may not exist yet, or be deleted and recreated (e.g.
+    when ffmpeg is restarted), so watch it whenever it exists.
+    '''
+    try:
+        fd = inotify_init()
+    except InotifyUnavailable as e:
+        reason, *_ = e.args
+        print(
+            f'WARNING: falling back to polling the playlist, '
+            f'could not use inotify: {reason}'
+        )
+        return await poll_playlist(rendition)
+
+    playlist_name = os.path.basename(rendition['playlist_path'])
+    names = set()
+    watch = {'watching': False}
+    readable = asyncio.Event()
+    def on_readable():
+        # Drain the fd right away: the reader is level-triggered, so an
+        # undrained fd would be reported readable again and again while
+        # we're busy refreshing the playlist
+        new_names, unwatched = read_inotify_events(fd)
+        names.update(new_names)
+        if unwatched:
+            watch['watching'] = False
+        readable.set()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(fd, on_readable)
+    try:
+        while True:
+            if not watch['watching']:
+                try:
+                    inotify_watch_directory(fd, rendition['directory'])
+                except OSError:
+                    # Wait for the directory to be created
+                    await refresh_playlist(rendition)
+                    await asyncio.sleep(
+                        CONFIG['SEGMENT_PLAYLIST_CACHE_LIFETIME']
+                    )
+                    continue
+                watch['watching'] = True
+                # The playlist may have been written before we were watching
+                await refresh_playlist(rendition)
+                continue
+
+            # Time out every so often so we notice when the playlist
+            # goes stale (ffmpeg stopped writing it)
+            try:
+                await asyncio.wait_for(
+                    readable.wait(),
+                    CONFIG['SEGMENT_PLAYLIST_STALE_THRESHOLD'],
+                )
+            except asyncio.TimeoutError:
+                await refresh_playlist(rendition)
+            else:
+                readable.clear()
+                playlist_written = playlist_name in names
+                names.clear()
+                if playlist_written:
+                    await refresh_playlist(rendition)
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+async def poll_playlist(rendition):
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.path.getmtime(rendition['playlist_path'])
+        except OSError:
+            mtime = None
+        if mtime != last_mtime:
+            last_mtime = mtime
+            await refresh_playlist(rendition)
+        elif rendition['offline'] is None:
+            # Forget the segments in memory once the playlist goes stale
+            try:
+                get_playlist(rendition)
+            except Offline:
+                await refresh_playlist(rendition)
+        await asyncio.sleep(CONFIG['SEGMENT_PLAYLIST_CACHE_LIFETIME'])
+
+def get_starting_segment(rendition):
     '''
     Instead of choosing the most recent segment, try choosing a segment that
     preceeds the most recent one by a little bit. Doing this increases the
     buffer of initially available video, which makes playback more stable.
+    Returns the segment's media sequence number along with the segment.
     '''
     print(f'[debug @ {time.time():.3f}] get_starting_segment()')
-    playlist, _ = get_playlist()
+    playlist, _ = get_playlist(rendition)
     index = max(0, len(playlist.segments) - CONFIG['SEGMENT_STREAM_INITIAL_BUFFER'])
-    return playlist.segments[index]
+    return rendition['media_sequence'] + index, playlist.segments[index]
 
-def get_next_segment(uri):
+def get_segment_by_sequence(rendition, sequence):
     '''
-    Look for the segment with uri `uri` and return the segment that
-    follows it, or None if no such segment exists.
+    Return the segment with media sequence number `sequence`, or None if
+    no such segment is in the playlist.
     '''
-    #print(f'[debug @ {time.time():.3f}] get_next_segment({uri!r})')
-    playlist, _ = get_playlist()
-    found = False
-    for segment in playlist.segments:
-        if found:
-            break
-        elif segment.uri == uri:
-            found = True
+    playlist, _ = get_playlist(rendition)
+    index = sequence - rendition['media_sequence']
+    if 0 <= index < len(playlist.segments):
+        segment = playlist.segments[index]
     else:
         segment = None
     return segment
 
-async def get_segment_uris(token):
+async def get_segment_uris(token, rendition):
+    '''
+    Yield (uri, duration) for each segment of `rendition` to send, and
+    for init sections (with a duration of None).
+    '''
     try:
-        segment = get_starting_segment()
+        sequence, segment = get_starting_segment(rendition)
     except Offline as e:
         reason, *_ = e.args
         print(
@@ -97,15 +411,15 @@ async def get_segment_uris(token):
         return
 
     if segment.init_section is not None:
-        yield segment.init_section.uri
+        yield segment.init_section.uri, None
 
     while True:
-        yield segment.uri
+        yield segment.uri, segment.duration
 
         t0 = time.monotonic()
         while True:
             try:
-                next_segment = get_next_segment(segment.uri)
+                next_segment = get_segment_by_sequence(rendition, sequence + 1)
             except Offline as e:
                 reason, *_ = e.args
                 print(
@@ -115,10 +429,11 @@ async def get_segment_uris(token):
                 )
                 return
             else:
+                searching_for = time.monotonic() - t0
                 if next_segment is not None:
-                    segment = next_segment
+                    sequence, segment = sequence + 1, next_segment
                     break
-                elif time.monotonic() - t0 >= CONFIG['SEGMENT_SEARCH_TIMEOUT']:
+                elif searching_for >= CONFIG['SEGMENT_SEARCH_TIMEOUT']:
                     print(
                         f'[debug @ {time.time():.3f}: token={token}] '
                         f'timed out looking for the segment following '
@@ -127,22 +442,216 @@ async def get_segment_uris(token):
                     )
                     return
                 else:
-                    await asyncio.sleep(CONFIG['SEGMENT_SEARCH_COOLDOWN'])
+                    await wait_for_new_segments(
+                        CONFIG['SEGMENT_SEARCH_TIMEOUT'] - searching_for
+                    )
+
+async def wait_for_new_segments(timeout):
+    '''
+    Wait until the playlist watcher has refreshed the playlist or until
+    `timeout` seconds have passed, whichever comes first.
+    '''
+    async with SEGMENTS_CONDITION:
+        try:
+            await asyncio.wait_for(SEGMENTS_CONDITION.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def get_playlist_uris(playlist):
+    init_uri = None
+    for segment in playlist.segments:
+        if segment.init_section is not None:
+            if segment.init_section.uri != init_uri:
+                init_uri = segment.init_section.uri
+                yield init_uri
+        yield segment.uri
+
+def cache_segment(key, segment):
+    '''
+    Put a segment in the segment cache, then evict the least recently
+    used segments until the cache is within its byte budget.
+    '''
+    if len(segment) > CONFIG['SEGMENT_CACHE_BYTES']:
+        return
+    try:
+        existing_segment = SEGMENT_CACHE['segments'].pop(key)
+    except KeyError:
+        pass
+    else:
+        SEGMENT_CACHE['size'] -= len(existing_segment)
+    SEGMENT_CACHE['segments'][key] = segment
+    SEGMENT_CACHE['size'] += len(segment)
+    while SEGMENT_CACHE['size'] > CONFIG['SEGMENT_CACHE_BYTES']:
+        _, evicted_segment = SEGMENT_CACHE['segments'].popitem(last=False)
+        SEGMENT_CACHE['size'] -= len(evicted_segment)
+
+def get_cached_segment(path):
+    '''
+    Return the contents of the segment at `path` if it is in the segment
+    cache, otherwise None. The segment cache is keyed by path and mtime,
+    so a segment that has been rewritten since it was cached is a miss.
+    '''
+    if CONFIG['SEGMENT_CACHE_BYTES'] == 0:
+        return None
+    try:
+        key = (path, os.path.getmtime(path))
+    except OSError:
+        return None
+    try:
+        segment = SEGMENT_CACHE['segments'][key]
+    except KeyError:
+        SEGMENT_CACHE['misses'] += 1
+        segment = None
+    else:
+        SEGMENT_CACHE['hits'] += 1
+        SEGMENT_CACHE['segments'].move_to_end(key)
+    return segment
+
+async def read_segment_into_cache(rendition, path):
+    stat = os.stat(path)
+    # Don't read a segment the cache couldn't hold anyway
+    if stat.st_size > CONFIG['SEGMENT_CACHE_BYTES']:
+        return
+    key = (path, stat.st_mtime)
+    if key not in SEGMENT_CACHE['segments']:
+        async with aiofiles.open(path, 'rb') as fp:
+            segment = await fp.read()
+        cache_segment(key, segment)
+    rendition['cached_keys'].add(key)
+
+async def cache_new_segments(rendition, playlist):
+    '''
+    Read the segments in `playlist` that weren't in the last playlist
+    into the segment cache. Each segment is read from disk once no
+    matter how many people are watching.
+    '''
+    if CONFIG['SEGMENT_CACHE_BYTES'] == 0:
+        return
+    if rendition['offline'] is None:
+        old_uris = set(get_playlist_uris(rendition['playlist']))
+    else:
+        old_uris = set()
+    for uri in get_playlist_uris(playlist):
+        if uri in old_uris:
+            continue
+        try:
+            path = path_for(rendition, uri)
+        except UnsafePath as e:
+            unsafe_path, *_ = e.args
+            print(
+                f'[debug @ {time.time():.3f}] '
+                f'not reading segment {uri=} with {unsafe_path=}'
+            )
+            continue
+        try:
+            await read_segment_into_cache(rendition, path)
+        except OSError as e:
+            print(
+                f'[debug @ {time.time():.3f}] '
+                f'segment {uri=} at {path=} cannot be read: {e}'
+            )
+
+def evict_old_segments(rendition, playlist):
+    '''
+    Drop every segment of `rendition` that isn't in `playlist` from the
+    segment cache. Nobody is going to ask for them again. Renditions may
+    share a directory, so only segments cached for `rendition` are
+    considered.
+    '''
+    paths = set()
+    if playlist is not None:
+        for uri in get_playlist_uris(playlist):
+            try:
+                paths.add(path_for(rendition, uri))
+            except UnsafePath:
+                pass
+    for key in tuple(rendition['cached_keys']):
+        path, _ = key
+        if path not in paths:
+            rendition['cached_keys'].remove(key)
+            # It may already have been evicted to stay within the budget
+            evicted_segment = SEGMENT_CACHE['segments'].pop(key, None)
+            if evicted_segment is not None:
+                SEGMENT_CACHE['size'] -= len(evicted_segment)
 
-def path_for(uri):
+def path_for(rendition, uri):
     path = os.path.normpath(
-        os.path.join(CONFIG['SEGMENT_DIRECTORY'], uri)
+        os.path.join(rendition['directory'], uri)
     )
-    if os.path.dirname(path) != CONFIG['SEGMENT_DIRECTORY']:
+    if os.path.dirname(path) != rendition['directory']:
         raise UnsafePath(path)
     return path
 
-async def segments(segment_read_hook=lambda uri: None, token=None):
+def get_next_chunk_size(chunk_size, sent_in):
+    '''
+    Adapt the chunk size to how long the last chunk took to be sent
+    (`sent_in` seconds). Keep doubling it while the client keeps up, and
+    halve it only for clients that are struggling, within the bounds of
+    SEGMENT_CHUNK_SIZE and SEGMENT_MAX_CHUNK_SIZE. If those are equal,
+    the chunk size is fixed.
+    '''
+    if sent_in < CHUNK_SIZE_GROW_THRESHOLD:
+        chunk_size *= 2
+    elif sent_in >= CHUNK_SIZE_SHRINK_THRESHOLD:
+        chunk_size //= 2
+    return max(
+        CONFIG['SEGMENT_CHUNK_SIZE'],
+        min(chunk_size, CONFIG['SEGMENT_MAX_CHUNK_SIZE']),
+    )
+
+def should_downgrade(n_bytes, duration, sent_in):
+    '''
+    Return True if the client received `n_bytes` of a segment `duration`
+    seconds long in `sent_in` seconds, and that means it can't keep up.
+    Sending only blocks when the client isn't reading fast enough, so a
+    fast client has a very small `sent_in`.
+    '''
+    if duration is None or duration <= 0 or sent_in <= 0:
+        return False
+    throughput = n_bytes / sent_in
+    bitrate = n_bytes / duration
+    return throughput < bitrate * RENDITION_DOWNGRADE_HEADROOM
+
+def get_segments_behind(rendition, uri):
+    '''
+    Return how many segments in the playlist come after the segment with
+    uri `uri`, or None if there is no such segment.
+    '''
+    try:
+        index = rendition['index_by_uri'][uri]
+        playlist, _ = get_playlist(rendition)
+    except (KeyError, Offline):
+        return None
+    return len(playlist.segments) - 1 - index
+
+async def segments(
+    segment_read_hook=lambda uri: None,
+    segment_sent_hook=lambda uri, **stats: None,
+    downgrade_hook=lambda rendition_name: None,
+    token=None,
+    rendition_name=None,
+):
+    '''
+    Yield the segments of one rendition. A progressive mp4 can't change
+    codec parameters midway, so rather than switch to a lower rendition
+    when the client can't keep up, stop and let `downgrade_hook` arrange
+    for the next response to use the lower rendition.
+    '''
     print(f'[debug @ {time.time():.3f}: token={token}] entering segment generator')
-    async for uri in get_segment_uris(token):
+    try:
+        rendition = choose_rendition(rendition_name)
+    except Offline as e:
+        reason, *_ = e.args
+        print(
+            f'[debug @ {time.time():.3f}: token={token}] '
+            f'stream went offline before we could choose a rendition ({reason})'
+        )
+        return
+    chunk_size = CONFIG['SEGMENT_CHUNK_SIZE']
+    async for uri, duration in get_segment_uris(token, rendition):
         #print(f'[debug @ {time.time():.3f}: token={token}] {uri=}')
         try:
-            path = path_for(uri)
+            path = path_for(rendition, uri)
         except UnsafePath as e:
             unsafe_path, *_ = e.args
             print(
@@ -160,20 +669,69 @@ async def segments(segment_read_hook=lambda uri: None, token=None):
                 f'told to stop sending segments: {reason}'
             )
             break
-        try:
-            async with aiofiles.open(path, 'rb') as fp:
-                while chunk := await fp.read(8192):
-                    yield chunk
-        except FileNotFoundError:
-            print(
-                f'[debug @ {time.time():.3f}: token={token}] '
-                f'segment {uri=} at {path=} unexpectedly does not exist'
-            )
-            break
-        except OSError as e:
+
+        segments_behind = get_segments_behind(rendition, uri)
+        segment = get_cached_segment(path)
+        sent_in = 0.0
+        if segment is not None:
+            n_bytes = len(segment)
+            offset = 0
+            while offset < n_bytes:
+                chunk = segment[offset:offset + chunk_size]
+                t0 = time.monotonic()
+                yield chunk
+                offset += len(chunk)
+                chunk_sent_in = time.monotonic() - t0
+                sent_in += chunk_sent_in
+                chunk_size = get_next_chunk_size(chunk_size, chunk_sent_in)
+        else:
+            # Not in memory: let the server send the file itself
+            try:
+                fp = open(path, 'rb')
+                try:
+                    n_bytes = os.fstat(fp.fileno()).st_size
+                except OSError:
+                    fp.close()
+                    raise
+            except FileNotFoundError:
+                print(
+                    f'[debug @ {time.time():.3f}: token={token}] '
+                    f'segment {uri=} at {path=} unexpectedly does not exist'
+                )
+                break
+            except OSError as e:
+                print(
+                    f'[debug @ {time.time():.3f}: token={token}] '
+                    f'segment {uri=} at {path=} cannot be read: {e}'
+                )
+                break
+            else:
+                # The generator resumes once the server has sent the file
+                t0 = time.monotonic()
+                yield FileBody(fp, chunk_size)
+                sent_in = time.monotonic() - t0
+                # Adapt the chunk size to the average chunk's send time
+                n_chunks = max(1, -(-n_bytes // chunk_size))
+                chunk_size = get_next_chunk_size(chunk_size, sent_in / n_chunks)
+
+        segment_sent_hook(
+            uri,
+            rendition=rendition['name'],
+            n_bytes=n_bytes,
+            sent_in=sent_in,
+            segments_behind=segments_behind,
+            stalled=duration is not None and sent_in > duration,
+        )
+        if (
+            should_downgrade(n_bytes, duration, sent_in)
+            and (lower_rendition := get_lower_rendition(rendition))
+        ):
             print(
                 f'[debug @ {time.time():.3f}: token={token}] '
-                f'segment {uri=} at {path=} cannot be read: {e}'
+                f'downgrading from rendition {rendition["name"]!r} '
+                f'to {lower_rendition["name"]!r}: a {duration:.1f}s '
+                f'segment took {sent_in:.1f}s to send'
             )
+            downgrade_hook(lower_rendition['name'])
             break
     print(f'[debug @ {time.time():.3f}: token={token}] exiting segment generator')
@@ -631,6 +631,144 @@ const update_users_list = () => {
   chat_users_notwatching_header.innerText = `Not watching (${notwatching})`;
 }
 
+/* websocket protocols (the server may send some payloads as msgpack, and may compress them) */
+const supports_deflate_raw = (() => {
+  try {
+    new DecompressionStream("deflate-raw");
+    return true;
+  } catch {
+    return false;
+  }
+})();
+const WEBSOCKET_PROTOCOLS = [
+  ...(supports_deflate_raw ? ["anonstream.msgpack+deflate", "anonstream.json+deflate"] : []),
+  "anonstream.msgpack",
+  "anonstream.json",
+];
+const text_decoder = new TextDecoder();
+const text_encoder = new TextEncoder();
+const msgpack_decode = (buffer) => {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  let offset = 0;
+  const read = (getter, size) => {
+    const value = view[getter](offset);
+    offset += size;
+    return value;
+  };
+  const str = (length) => {
+    const value = text_decoder.decode(bytes.subarray(offset, offset + length));
+    offset += length;
+    return value;
+  };
+  const bin = (length) => {
+    const value = bytes.slice(offset, offset + length);
+    offset += length;
+    return value;
+  };
+  const array = (length) => {
+    const value = [];
+    for (let i = 0; i < length; i++) {
+      value.push(decode());
+    }
+    return value;
+  };
+  const map = (length) => {
+    const value = {};
+    for (let i = 0; i < length; i++) {
+      const key = decode();
+      value[key] = decode();
+    }
+    return value;
+  };
+  const decode = () => {
+    const byte = bytes[offset++];
+    if (byte <= 0x7f) return byte;
+    if (byte <= 0x8f) return map(byte & 0x0f);
+    if (byte <= 0x9f) return array(byte & 0x0f);
+    if (byte <= 0xbf) return str(byte & 0x1f);
+    if (byte >= 0xe0) return byte - 0x100;
+    switch (byte) {
+      case 0xc0: return null;
+      case 0xc2: return false;
+      case 0xc3: return true;
+      case 0xc4: return bin(read("getUint8", 1));
+      case 0xc5: return bin(read("getUint16", 2));
+      case 0xc6: return bin(read("getUint32", 4));
+      case 0xca: return read("getFloat32", 4);
+      case 0xcb: return read("getFloat64", 8);
+      case 0xcc: return read("getUint8", 1);
+      case 0xcd: return read("getUint16", 2);
+      case 0xce: return read("getUint32", 4);
+      case 0xcf: return Number(read("getBigUint64", 8));
+      case 0xd0: return read("getInt8", 1);
+      case 0xd1: return read("getInt16", 2);
+      case 0xd2: return read("getInt32", 4);
+      case 0xd3: return Number(read("getBigInt64", 8));
+      case 0xd9: return str(read("getUint8", 1));
+      case 0xda: return str(read("getUint16", 2));
+      case 0xdb: return str(read("getUint32", 4));
+      case 0xdc: return array(read("getUint16", 2));
+      case 0xdd: return array(read("getUint32", 4));
+      case 0xde: return map(read("getUint16", 2));
+      case 0xdf: return map(read("getUint32", 4));
+      default: throw new Error(`unsupported msgpack type 0x${byte.toString(16)}`);
+    }
+  };
+  return decode();
+}
+const create_inflater = (dictionary) => {
+  // The server's compressor was primed with the dictionary. There's no way
+  // to give DecompressionStream a preset dictionary, but sending it the
+  // dictionary as an uncompressed block does the same thing.
+  const stream = new DecompressionStream("deflate-raw");
+  const writer = stream.writable.getWriter();
+  const reader = stream.readable.getReader();
+  const length = dictionary.length;
+  writer.write(new Uint8Array([0x00, length & 0xff, length >> 8, ~length & 0xff, (~length >> 8) & 0xff]));
+  writer.write(dictionary);
+  let skip = length;
+  let output = new Uint8Array(0);
+  return async (data) => {
+    const header = new DataView(data, 0, 5);
+    const binary = header.getUint8(0) !== 0;
+    const length = header.getUint32(1);
+    writer.write(new Uint8Array(data, 5));
+    while (output.length < skip + length) {
+      const {value} = await reader.read();
+      const joined = new Uint8Array(output.length + value.length);
+      joined.set(output);
+      joined.set(value, output.length);
+      output = joined;
+    }
+    const message = output.slice(skip, skip + length);
+    output = output.slice(skip + length);
+    skip = 0;
+    return binary ? msgpack_decode(message.buffer) : JSON.parse(text_decoder.decode(message));
+  };
+}
+// Websocket messages are decoded one at a time, in order, because
+// inflating is asynchronous and has to happen in the order they were sent
+let inflate = null;
+let websocket_decoding = Promise.resolve();
+const decode_websocket_data = (data) => {
+  const result = websocket_decoding.then(() => {
+    if (typeof data === "string") {
+      const receipt = JSON.parse(data);
+      if (receipt.type === "deflate") {
+        inflate = create_inflater(text_encoder.encode(receipt.dictionary));
+      }
+      return receipt;
+    } else if (inflate !== null) {
+      return inflate(data);
+    } else {
+      return msgpack_decode(data);
+    }
+  });
+  websocket_decoding = result.catch(() => null);
+  return result;
+}
+
 const show_offline_screen = () => {
   video.removeAttribute("src");
   video.load();
@@ -639,8 +777,12 @@ const show_offline_screen = () => {
 
 const on_websocket_message = async (event) => {
   //console.log("websocket message", event);
-  const receipt = JSON.parse(event.data);
+  const receipt = await decode_websocket_data(event.data);
   switch (receipt.type) {
+    case "deflate":
+      console.log("ws deflate", receipt);
+      break;
+
     case "error":
       console.log("ws error", receipt);
       chat_form_submit.disabled = false;
@@ -782,15 +924,56 @@ const on_websocket_message = async (event) => {
       }
       break;
 
+    case "messages":
+      console.log("ws messages", receipt);
+      // skip messages we already have (they may have been in init)
+      const present_messages = chat_messages.querySelectorAll(".chat-message");
+      const last_present = present_messages.length == 0 ? null : present_messages[present_messages.length - 1];
+      const last_present_seq = last_present === null ? null : parseInt(last_present.dataset.seq);
+      for (const message of receipt.messages) {
+        if (message.seq > last_present_seq) {
+          create_and_add_chat_message(message);
+        }
+      }
+      if (chat_messages.dataset.scrollLock === undefined) {
+        chat_messages.scrollTo({
+          left: 0,
+          top: chat_messages.scrollTopMax,
+          behavior: "smooth",
+        });
+      }
+      break;
+
     case "delete":
       console.log("ws delete", receipt);
       delete_chat_messages({string_seqs: new Set(receipt.seqs.map(n => n.toString()))});
       break;
 
     case "set-users":
-      console.log("ws set-users", receipt);
-      for (const token_hash of Object.keys(receipt.users)) {
-        users[token_hash] = receipt.users[token_hash];
+    case "reset-users":
+      console.log(`ws ${receipt.type}`, receipt);
+      if (receipt.type === "reset-users") {
+        users = receipt.users;
+      } else {
+        // updates only have the fields that changed since version `since`
+        let missed_update = false;
+        for (const token_hash of Object.keys(receipt.users)) {
+          const update = receipt.users[token_hash];
+          const user = users[token_hash];
+          if (update.since === undefined) {
+            users[token_hash] = update;
+          } else if (user !== undefined && user.version >= update.version) {
+            continue;
+          } else if (user === undefined || user.version !== update.since) {
+            missed_update = true;
+          } else {
+            users[token_hash] = {...user, ...update};
+          }
+        }
+        // if we missed an update, ask for every user again
+        if (missed_update) {
+          ws.send(JSON.stringify({type: "resync"}));
+        }
       }
 
       // if the chat is scrolled all the way to the bottom, make sure this is
@@ -892,7 +1075,9 @@ const connect_websocket = () => {
   chat_live_ball.style.borderColor = "gold";
   chat_live_status.innerHTML = "<span data-verbose='true'>Connecting to chat...</span><span data-verbose='false'>&middot;&middot;&middot;</span>";
   ws = null;
-  ws = new WebSocket(`ws://${document.domain}:${location.port}/live?token=${encodeURIComponent(TOKEN)}`);
+  inflate = null;
+  ws = new WebSocket(`ws://${document.domain}:${location.port}/live?token=${encodeURIComponent(TOKEN)}`, WEBSOCKET_PROTOCOLS);
+  ws.binaryType = "arraybuffer";
   ws.addEventListener("open", (event) => {
     console.log("websocket open", event);
     chat_form_submit.disabled = false;
@@ -940,6 +1125,12 @@ info_button.addEventListener("click", (event) => {
   video.load();
   info_button.removeAttribute("data-visible");
 });
+video.addEventListener("ended", (event) => {
+  // the server ends the stream to switch us to a lower rendition,
+  // reconnecting gets us that rendition (or the offline screen)
+  video.src = `/stream.mp4?token=${encodeURIComponent(TOKEN)}`;
+  video.load();
+});
 video.addEventListener("error", (event) => {
   if (video.error !== null && video.networkState === video.NETWORK_NO_SOURCE) {
     show_offline_screen();
@@ -7,16 +7,19 @@ from functools import wraps
 
 from quart import current_app, websocket
 
-from anonstream.broadcast import broadcast, broadcast_users_update
+from anonstream.broadcast import broadcast, publish, broadcast_users_update, broadcast_messages_buffer, enqueue
+from anonstream.segments import watch_renditions
 from anonstream.stream import is_online, get_stream_title, get_stream_uptime_and_viewership
 from anonstream.user import get_absent_users, get_sunsettable_users, deverify, ensure_allowedness, AllowednessException
 from anonstream.wrappers import with_timestamp
+from anonstream.utils.websocket import Frame
 
 CONFIG = current_app.config
 MESSAGES = current_app.messages
 USERS_BY_TOKEN = current_app.users_by_token
 USERS = current_app.users
 CAPTCHAS = current_app.captchas
+WEBSOCKET_QUEUES = current_app.websocket_queues
 CAPTCHA_SIGNER = current_app.captcha_signer
 
 async def cancel_on_shutdown(coro):
@@ -88,13 +91,10 @@ async def t_sunset_users(timestamp, iteration):
         token_hashes.append(user['token_hash'])
 
     if token_hashes:
-        broadcast(
-            users=USERS,
-            payload={
-                'type': 'rem-users',
-                'token_hashes': token_hashes,
-            },
-        )
+        publish({
+            'type': 'rem-users',
+            'token_hashes': token_hashes,
+        })
 
 @with_period(CONFIG['TASK_ROTATE_CAPTCHAS'])
 async def t_expire_captchas(iteration):
@@ -120,25 +120,30 @@ async def t_close_websockets(timestamp, iteration):
     if iteration == 0:
         return
     else:
-        for user in USERS:
-            for queue in user['websockets']:
-                # Check allowedness
-                try:
-                    ensure_allowedness(user, timestamp=timestamp)
-                except AllowednessException:
-                    queue.put_nowait({'type': 'kick'})
-                # Check expiry
-                last_pong = user['websockets'][queue]
-                last_pong_ago = timestamp - last_pong
-                if last_pong_ago > THRESHOLD:
-                    queue.put_nowait({'type': 'close'})
+        for queue, user in WEBSOCKET_QUEUES.items():
+            # Check allowedness
+            try:
+                ensure_allowedness(user, timestamp=timestamp)
+            except AllowednessException:
+                enqueue(user, queue, Frame({'type': 'kick'}))
+            # Check expiry
+            last_pong = user['websockets'][queue]
+            last_pong_ago = timestamp - last_pong
+            if last_pong_ago > THRESHOLD:
+                enqueue(user, queue, Frame({'type': 'close'}))
+
+async def t_watch_renditions():
+    try:
+        await cancel_on_shutdown(watch_renditions())
+    except asyncio.CancelledError:
+        pass
 
 @with_period(CONFIG['TASK_BROADCAST_PING'])
 async def t_broadcast_ping(iteration):
     if iteration == 0:
         return
     else:
-        broadcast(USERS, payload={'type': 'ping'})
+        publish({'type': 'ping'})
 
 @with_period(CONFIG['TASK_BROADCAST_USERS_UPDATE'])
 async def t_broadcast_users_update(iteration):
@@ -147,6 +152,10 @@ async def t_broadcast_users_update(iteration):
     else:
         broadcast_users_update()
 
+@with_period(CONFIG['CHAT_BROADCAST_TICK'])
+async def t_broadcast_messages(iteration):
+    broadcast_messages_buffer()
+
 @with_period(CONFIG['TASK_BROADCAST_STREAM_INFO_UPDATE'])
 @with_timestamp(precise=True)
 async def t_broadcast_stream_info_update(timestamp, iteration):
@@ -197,7 +206,7 @@ async def t_broadcast_stream_info_update(timestamp, iteration):
                     'viewership': viewership,
                 }
         if info:
-            broadcast(USERS, payload={'type': 'info', **info})
+            publish({'type': 'info', **info})
 
     current_app.last_info_task = timestamp
 
@@ -205,6 +214,9 @@ current_app.add_background_task(t_delete_eyes)
 current_app.add_background_task(t_sunset_users)
 current_app.add_background_task(t_expire_captchas)
 current_app.add_background_task(t_close_websockets)
+current_app.add_background_task(t_watch_renditions)
 current_app.add_background_task(t_broadcast_ping)
 current_app.add_background_task(t_broadcast_users_update)
 current_app.add_background_task(t_broadcast_stream_info_update)
+if CONFIG['CHAT_BROADCAST_TICK'] is not None:
+    current_app.add_background_task(t_broadcast_messages)
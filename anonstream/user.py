@@ -17,7 +17,6 @@ from anonstream.utils.colour import color_to_colour, get_contrast, NotAColor
 from anonstream.utils.user import get_user_for_websocket, trilean
 
 CONFIG = current_app.config
-MESSAGES = current_app.messages
 USERS = current_app.users
 ALLOWEDNESS = current_app.allowedness
 CAPTCHA_SIGNER = current_app.captcha_signer
@@ -211,13 +210,7 @@ def deverify(user, timestamp=None):
     if timestamp is None:
         timestamp = get_timestamp()
     if user['verified'] and not user['broadcaster']:
-        n_user_messages = 0
-        for message in reversed(MESSAGES):
-            message_sent_ago = timestamp - message['timestamp']
-            if message_sent_ago >= CONFIG['FLOOD_MESSAGE_DURATION']:
-                break
-            elif message['token'] == user['token']:
-                n_user_messages += 1
+        n_user_messages = user['recent_messages'].get_total(timestamp)
         if n_user_messages >= CONFIG['FLOOD_MESSAGE_THRESHOLD']:
             user['verified'] = False
 
@@ -252,10 +245,7 @@ def is_sunsettable(user):
     return user['presence'] == Presence.ABSENT and not has_left_messages(user)
 
 def has_left_messages(user):
-    return any(
-        message['token'] == user['token']
-        for message in MESSAGES
-    )
+    return user['n_messages'] > 0
 
 def get_sunsettable_users(timestamp):
     return filter(
@@ -313,6 +303,11 @@ def create_eyes(timestamp, user, headers):
         'id': eyes_id,
         'token': user['token'],
         'n_segments': 0,
+        'rendition': None,
+        'bytes_sent': 0,
+        'send_time': 0.0,
+        'segments_behind': None,
+        'stalls': 0,
         'headers': headers,
         'created': timestamp,
         'renewed': timestamp,
@@ -342,6 +337,34 @@ def renew_eyes(timestamp, user, eyes_id, just_read_new_segment=False):
         eyes['n_segments'] += 1
     eyes['renewed'] = timestamp
 
+def record_eyes_send(
+    user, eyes_id, rendition, n_bytes, sent_in, segments_behind, stalled,
+):
+    '''
+    Add the measurements of one segment sent to eyes `eyes_id`. A stall
+    is a segment that took longer to send than it takes to play.
+    '''
+    try:
+        eyes = user['eyes']['current'][eyes_id]
+    except KeyError:
+        return
+    eyes['rendition'] = rendition
+    eyes['bytes_sent'] += n_bytes
+    eyes['send_time'] += sent_in
+    eyes['segments_behind'] = segments_behind
+    if stalled:
+        eyes['stalls'] += 1
+
+def downgrade_eyes(user, eyes_id, rendition_name):
+    '''
+    End eyes `eyes_id` because the user couldn't keep up with its
+    rendition, and have the user's next eyes use `rendition_name`
+    instead. The user reconnects straight away, so lift the cooldown.
+    '''
+    user['eyes']['current'].pop(eyes_id, None)
+    user['rendition'] = rendition_name
+    user['last']['eyes'] = -inf
+
 def ensure_allowedness(user, timestamp=None):
     if timestamp is None:
         timestamp = get_timestamp()
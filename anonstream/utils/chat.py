@@ -14,6 +14,112 @@ from quart import escape
 class NonceReuse(Exception):
     pass
 
+class ChatStore:
+    '''
+    Chat messages in the order they were added, in a ring buffer of
+    `capacity` slots. Adding a message to a full buffer evicts the
+    oldest slot. Deleting a message empties its slot and leaves a hole
+    that is skipped over and eventually evicted. Messages are indexed by
+    seq (to their slot) and by id (to their seq).
+    '''
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.start = 0
+        self.length = 0
+        self.slot_by_seq = {}
+        self.seq_by_id = {}
+        self.last_seq = None
+
+    def __len__(self):
+        return len(self.seq_by_id)
+
+    def __contains__(self, message_id):
+        return message_id in self.seq_by_id
+
+    def _slot(self, offset):
+        return (self.start + offset) % len(self.slots)
+
+    def __iter__(self):
+        for offset in range(self.length):
+            message = self.slots[self._slot(offset)]
+            if message is not None:
+                yield message
+
+    def __reversed__(self):
+        for offset in reversed(range(self.length)):
+            message = self.slots[self._slot(offset)]
+            if message is not None:
+                yield message
+
+    def _evict_oldest(self):
+        message = self.slots[self.start]
+        self.slots[self.start] = None
+        self.start = self._slot(1)
+        self.length -= 1
+        if message is not None:
+            self.slot_by_seq.pop(message['seq'])
+            self.seq_by_id.pop(message['id'])
+        return message
+
+    def _trim_holes(self):
+        while self.length > 0 and self.slots[self.start] is None:
+            self.start = self._slot(1)
+            self.length -= 1
+        while self.length > 0 and self.slots[self._slot(self.length - 1)] is None:
+            self.length -= 1
+
+    def append(self, message):
+        '''
+        Add a message and return the messages evicted to make room for it.
+        With a capacity of 0 the message itself is evicted straight away.
+        '''
+        if not self.slots:
+            self.last_seq = message['seq']
+            return [message]
+        evicted = []
+        if self.length == len(self.slots):
+            evicted_message = self._evict_oldest()
+            if evicted_message is not None:
+                evicted.append(evicted_message)
+            self._trim_holes()
+        slot = self._slot(self.length)
+        self.slots[slot] = message
+        self.length += 1
+        self.slot_by_seq[message['seq']] = slot
+        self.seq_by_id[message['id']] = message['seq']
+        self.last_seq = message['seq']
+        return evicted
+
+    def delete(self, seqs):
+        '''
+        Delete the messages with these seqs and return them. Seqs that
+        aren't in the store are ignored.
+        '''
+        deleted = []
+        for seq in seqs:
+            slot = self.slot_by_seq.pop(seq, None)
+            if slot is None:
+                continue
+            message = self.slots[slot]
+            self.slots[slot] = None
+            self.seq_by_id.pop(message['id'])
+            deleted.append(message)
+        self._trim_holes()
+        return deleted
+
+    def get_last(self, n):
+        '''
+        Return the most recent `n` messages, oldest first, without going
+        through the older messages.
+        '''
+        messages = []
+        for message in reversed(self):
+            if len(messages) >= n:
+                break
+            messages.append(message)
+        messages.reverse()
+        return messages
+
 def generate_nonce():
     return secrets.token_urlsafe(16)
 
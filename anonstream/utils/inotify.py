@@ -0,0 +1,79 @@
+# SPDX-FileCopyrightText: 2022 n9k <https://gitler.moe/ninya9k>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+import ctypes
+import ctypes.util
+import os
+import struct
+from functools import lru_cache
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class InotifyUnavailable(Exception):
+    pass
+
+@lru_cache
+def get_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        for function in ('inotify_init1', 'inotify_add_watch'):
+            getattr(libc, function)
+    except (OSError, AttributeError) as e:
+        raise InotifyUnavailable(f'no inotify in libc: {e}') from e
+    return libc
+
+def inotify_init():
+    '''
+    Return a new non-blocking inotify file descriptor that isn't watching
+    anything yet.
+    '''
+    fd = get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+    return fd
+
+def inotify_watch_directory(fd, directory):
+    '''
+    Make the inotify file descriptor `fd` readable whenever a file in
+    `directory` is written to or moved into place. Raises OSError if
+    `directory` can't be watched, e.g. because it doesn't exist.
+    '''
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+    if get_libc().inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), directory)
+
+def read_inotify_events(fd):
+    '''
+    Read the events that are currently waiting to be read from the
+    inotify file descriptor `fd`. Return the set of filenames they
+    mention, and whether the watched directory was deleted (in which
+    case it isn't being watched any more).
+    '''
+    names = set()
+    unwatched = False
+    while True:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            break
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & (IN_DELETE_SELF | IN_IGNORED):
+                unwatched = True
+            if name:
+                names.add(os.fsdecode(name))
+    return names, unwatched
@@ -0,0 +1,64 @@
+# SPDX-FileCopyrightText: 2022 n9k <https://gitler.moe/ninya9k>
+# SPDX-License-Identifier: AGPL-3.0-or-later
+
+from collections import deque
+
+class SlidingWindow:
+    '''
+    Amounts added in the last `duration` seconds, with a running total
+    so reading the total doesn't mean adding them all up again.
+    '''
+    def __init__(self, duration):
+        self.duration = duration
+        self.entries = deque()
+        self.total = 0
+
+    def expire(self, timestamp):
+        while self.entries:
+            entry_timestamp, amount = self.entries[0]
+            if timestamp - entry_timestamp >= self.duration:
+                self.entries.popleft()
+                self.total -= amount
+            else:
+                break
+
+    def get_total(self, timestamp):
+        self.expire(timestamp)
+        return self.total
+
+    def add(self, timestamp, amount=1):
+        self.expire(timestamp)
+        self.entries.append((timestamp, amount))
+        self.total += amount
+
+class TokenBucket:
+    '''
+    A bucket that amounts are added to and that drains by `threshold`
+    every `duration` seconds. Unlike a sliding window, a burst is
+    forgotten gradually instead of all at once when it leaves the window.
+    '''
+    def __init__(self, duration, threshold):
+        self.rate = threshold / duration
+        self.total = 0
+        self.updated = None
+
+    def expire(self, timestamp):
+        if self.updated is not None:
+            drained = (timestamp - self.updated) * self.rate
+            self.total = max(0, self.total - drained)
+        self.updated = timestamp
+
+    def get_total(self, timestamp):
+        self.expire(timestamp)
+        return self.total
+
+    def add(self, timestamp, amount=1):
+        self.expire(timestamp)
+        self.total += amount
+
+def create_ratelimit(mode, duration, threshold):
+    match mode:
+        case 'window':
+            return SlidingWindow(duration)
+        case 'bucket':
+            return TokenBucket(duration, threshold)
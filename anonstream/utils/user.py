@@ -45,12 +45,43 @@ def trilean(presence):
         case _:
             return None
 
-def get_user_for_websocket(user):
+def get_user_fields_for_websocket(user):
     return {
         **{key: user[key] for key in USER_WEBSOCKET_ATTRS},
         'watching': trilean(user['presence']),
     }
 
+def get_user_for_websocket(user):
+    return {
+        **get_user_fields_for_websocket(user),
+        'version': user['update_version'],
+    }
+
+def get_user_update_for_websocket(user):
+    '''
+    Return the fields of a user that changed since the user was last in
+    a users update, or None if none did. Each update bumps the user's
+    version. An update says which version it applies to (`since`) so
+    clients can tell when they missed one. The first update of a user
+    has every field and no `since`.
+    '''
+    fields = get_user_fields_for_websocket(user)
+    if user['update_fields'] is None:
+        update = fields.copy()
+    else:
+        update = {
+            key: value
+            for key, value in fields.items()
+            if user['update_fields'].get(key) != value
+        }
+        if not update:
+            return None
+        update['since'] = user['update_version']
+    user['update_version'] += 1
+    user['update_fields'] = fields
+    update['version'] = user['update_version']
+    return update
+
 def identifying_string(user, ansi=True):
     tag = user['tag']
     token_hash = f'{user["token_hash"][:4]}..'
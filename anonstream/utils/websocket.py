@@ -1,13 +1,238 @@
 # SPDX-FileCopyrightText: 2022 n9k <https://gitler.moe/ninya9k>
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
+import json
+import struct
+import zlib
 from enum import Enum
 
-WS = Enum('WS', names=('PONG', 'MESSAGE', 'CAPTCHA', 'APPEARANCE'))
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WS = Enum('WS', names=('PONG', 'MESSAGE', 'CAPTCHA', 'APPEARANCE', 'RESYNC'))
+
+# Websocket subprotocols, most preferred first: (name, msgpack, deflate)
+WEBSOCKET_PROTOCOLS = (
+    ('anonstream.msgpack+deflate', True, True),
+    ('anonstream.json+deflate', False, True),
+    ('anonstream.msgpack', True, False),
+    ('anonstream.json', False, False),
+)
+
+# Websockets can subscribe to only some topics. Payloads that aren't in
+# any topic (pings, kicks, replies to the websocket itself) always get sent.
+TOPIC_BY_PAYLOAD_TYPE = {
+    'message': 'chat',
+    'messages': 'chat',
+    'delete': 'chat',
+    'set-users': 'users',
+    'rem-users': 'users',
+    'info': 'info',
+}
+TOPICS = frozenset(TOPIC_BY_PAYLOAD_TYPE.values())
+
+# Prefixed to each deflated frame: whether the uncompressed data is msgpack
+# (otherwise it's json text), and the length of the uncompressed data
+DEFLATE_HEADER = struct.Struct('>?I')
+
+# Payloads sent as binary msgpack frames to clients that asked for msgpack,
+# every other payload is always sent as a json text frame
+MSGPACK_PAYLOAD_TYPES = {
+    'init', 'message', 'messages', 'set-users', 'rem-users', 'reset-users',
+}
 
 class Malformed(Exception):
     pass
 
+class Frame:
+    '''
+    An outbound websocket payload. The payload is encoded the first time
+    it's sent, and every other socket it's sent to reuses that encoding.
+    '''
+    __slots__ = ('payload', '_text', '_packed')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._text = None
+        self._packed = None
+
+    @property
+    def type(self):
+        return self.payload['type']
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = json.dumps(self.payload)
+        return self._text
+
+    @property
+    def packed(self):
+        if self._packed is None:
+            self._packed = msgpack.packb(self.payload)
+        return self._packed
+
+    def data(self, binary):
+        if binary and self.type in MSGPACK_PAYLOAD_TYPES:
+            return self.packed
+        else:
+            return self.text
+
+class Deflater:
+    '''
+    One websocket's outbound compression: a raw deflate stream primed
+    with a preset dictionary, with context kept between frames. Each
+    frame is flushed so the client can inflate it as soon as it arrives.
+    '''
+    def __init__(self, level, dictionary, stats):
+        self.compressobj = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary,
+        )
+        self.stats = stats
+
+    def compress(self, data):
+        binary = isinstance(data, bytes)
+        if not binary:
+            data = data.encode()
+        compressed = (
+            self.compressobj.compress(data)
+            + self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+        )
+        self.stats['bytes_in'] += len(data)
+        self.stats['bytes_out'] += len(compressed)
+        return DEFLATE_HEADER.pack(binary, len(data)) + compressed
+
+def build_deflate_dictionary(user_websocket_attrs, default_names):
+    '''
+    Return a preset dictionary for websocket compression made of the
+    boilerplate of typical payloads. Parts near the end of the dictionary
+    are cheapest to refer to, so the most common payloads go last.
+    '''
+    user = {key: None for key in user_websocket_attrs}
+    samples = (
+        {'type': 'info', 'title': '', 'stats': {'uptime': 0, 'viewership': 0}},
+        {'type': 'rem-users', 'token_hashes': []},
+        {'type': 'ack', 'nonce': '', 'next': '', 'notice': None, 'clear': True, 'digest': ''},
+        {'type': 'set-users', 'users': {'': {**user, 'broadcaster': False, 'watching': True, 'version': 0}}},
+        {'type': 'set-users', 'users': {'': {'watching': False, 'since': 0, 'version': 0}}},
+        {
+            'type': 'message',
+            'message': {
+                'seq': 0,
+                'date': '',
+                'time_minutes': '',
+                'time_seconds': '',
+                'markup': '<img class="emote" src="/static/" alt="" title="">',
+                'token_hash': '',
+            },
+        },
+    )
+    dictionary = ''.join(map(json.dumps, samples)) + ''.join(default_names)
+    return dictionary.encode()
+
+def choose_websocket_protocol(requested_protocols, allow_deflate):
+    '''
+    Pick the websocket subprotocol to accept, and return it along with
+    whether it means msgpack and whether it means deflate. The protocol
+    is None if the client asked for none that we can speak (a client
+    that doesn't ask for a subprotocol speaks uncompressed json).
+    '''
+    for protocol, binary, deflate in WEBSOCKET_PROTOCOLS:
+        if binary and msgpack is None or deflate and not allow_deflate:
+            continue
+        if protocol in requested_protocols:
+            return protocol, binary, deflate
+    return None, False, False
+
+def parse_topics(string):
+    '''
+    Return the set of topics in the comma-separated `string`, ignoring
+    unknown topics. Every topic if `string` is None.
+    '''
+    if string is None:
+        return set(TOPICS)
+    return set(string.split(',')) & TOPICS
+
+def pack_map_items(mapping):
+    '''
+    Return the msgpack encoding of the items of `mapping`, without the
+    header that says how many there are.
+    '''
+    return b''.join(
+        msgpack.packb(key) + msgpack.packb(value)
+        for key, value in mapping.items()
+    )
+
+def splice_json(own, text):
+    '''
+    Return the json text of the object `text` with the items of the dict
+    `own` added to the front. `text` must not be an empty object.
+    '''
+    return json.dumps(own)[:-1] + ', ' + text[1:]
+
+def splice_msgpack(own, n_items, packed_items):
+    '''
+    Return the msgpack encoding of a map of `n_items` items packed with
+    `pack_map_items`, with the items of the dict `own` added to the front.
+    '''
+    header = msgpack.Packer().pack_map_header(len(own) + n_items)
+    return header + pack_map_items(own) + packed_items
+
+def coalesce_frames(frames):
+    '''
+    Drop frames that are superseded by a later frame: only the latest
+    ping frame is kept, and info frames (which may be partial) are merged
+    into the latest of them. set-users frames are merged into the first
+    of them, even across other frames such as messages, so later user
+    updates arrive earlier than they would have. That's harmless because
+    clients show every message with its user's current details anyway;
+    set-users frames are not merged across rem-users and reset-users
+    frames, which they can't be reordered with. Every other frame is
+    kept in order.
+    '''
+    def merge_user_updates(earlier, later):
+        merged = {**earlier, **later}
+        if 'since' in earlier:
+            merged['since'] = earlier['since']
+        else:
+            merged.pop('since', None)
+        return merged
+
+    coalesced = []
+    latest = {}
+    for frame in frames:
+        match frame.type:
+            case 'info' | 'ping':
+                index = latest.get(frame.type)
+                if index is not None:
+                    earlier, coalesced[index] = coalesced[index], None
+                    if frame.type == 'info':
+                        frame = Frame({**earlier.payload, **frame.payload})
+                latest[frame.type] = len(coalesced)
+                coalesced.append(frame)
+            case 'set-users':
+                index = latest.get('set-users')
+                if index is None:
+                    latest['set-users'] = len(coalesced)
+                    coalesced.append(frame)
+                else:
+                    earlier = coalesced[index]
+                    users = earlier.payload['users'].copy()
+                    for token_hash, update in frame.payload['users'].items():
+                        if token_hash in users:
+                            update = merge_user_updates(users[token_hash], update)
+                        users[token_hash] = update
+                    coalesced[index] = Frame({**earlier.payload, 'users': users})
+            case 'rem-users' | 'reset-users':
+                # Don't merge set-users frames across these frames
+                latest.pop('set-users', None)
+                coalesced.append(frame)
+            case _:
+                coalesced.append(frame)
+    return [frame for frame in coalesced if frame is not None]
+
 def get(t, pairs, key, default=None):
     value = pairs.get(key, default)
     if isinstance(value, t):
@@ -51,5 +276,8 @@ def parse_websocket_data(receipt):
         case 'pong':
             return WS.PONG, ()
 
+        case 'resync':
+            return WS.RESYNC, ()
+
         case _:
             raise Malformed('malformed type')
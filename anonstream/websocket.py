@@ -6,6 +6,7 @@ import json
 
 from quart import current_app, websocket
 
+from anonstream.broadcast import enqueue
 from anonstream.stream import get_stream_title, get_stream_uptime_and_viewership
 from anonstream.captcha import get_random_captcha_digest_for
 from anonstream.chat import get_all_messages_for_websocket, add_chat_message, Rejected
@@ -13,57 +14,127 @@ from anonstream.user import get_all_users_for_websocket, see, reading, verify, d
 from anonstream.wrappers import with_timestamp, get_timestamp
 from anonstream.utils.chat import generate_nonce
 from anonstream.utils.user import identifying_string
-from anonstream.utils.websocket import parse_websocket_data, Malformed, WS
+from anonstream.utils.websocket import parse_websocket_data, Malformed, WS, Frame, Deflater, coalesce_frames, pack_map_items, splice_json, splice_msgpack, build_deflate_dictionary
+from anonstream.utils.user import USER_WEBSOCKET_ATTRS
 
 CONFIG = current_app.config
+INIT_SNAPSHOT = current_app.init_snapshot
+WEBSOCKET_COMPRESSION = current_app.websocket_compression
 
-async def websocket_outbound(queue, user):
+DEFLATE_DICTIONARY = build_deflate_dictionary(
+    USER_WEBSOCKET_ATTRS,
+    (CONFIG['DEFAULT_HOST_NAME'], CONFIG['DEFAULT_ANON_NAME']),
+)
+
+async def get_init_snapshot():
+    '''
+    Return the part of the init payload that's the same for every
+    websocket, along with its encodings. It's only rebuilt after a
+    broadcast has changed it or once it has reached its lifetime.
+    '''
+    timestamp = get_timestamp(monotonic=True, precise=True)
+    built_ago = timestamp - INIT_SNAPSHOT['built']
+    if (
+        INIT_SNAPSHOT['built_version'] != INIT_SNAPSHOT['version']
+        or built_ago >= CONFIG['SOCKET_WEBSOCKET_INIT_CACHE_LIFETIME']
+    ):
+        version = INIT_SNAPSHOT['version']
+        title = await get_stream_title()
+        payload = {
+            'type': 'init',
+            'title': title,
+            'stats': get_stream_uptime_and_viewership(for_websocket=True),
+            'messages': get_all_messages_for_websocket(),
+            'users': get_all_users_for_websocket(),
+            'default': {
+                True: CONFIG['DEFAULT_HOST_NAME'],
+                False: CONFIG['DEFAULT_ANON_NAME'],
+            },
+            'scrollback': CONFIG['MAX_CHAT_SCROLLBACK'],
+            'pingpong': CONFIG['TASK_BROADCAST_PING'],
+            'maxlength': {
+                'comment': CONFIG['CHAT_COMMENT_MAX_LENGTH'],
+                'name': CONFIG['CHAT_NAME_MAX_LENGTH'],
+                'password': CONFIG['CHAT_TRIPCODE_PASSWORD_MAX_LENGTH'],
+            },
+        }
+        INIT_SNAPSHOT['payload'] = payload
+        INIT_SNAPSHOT['text'] = json.dumps(payload)
+        INIT_SNAPSHOT['packed_items'] = None
+        INIT_SNAPSHOT['built_version'] = version
+        INIT_SNAPSHOT['built'] = timestamp
+    return INIT_SNAPSHOT
+
+async def get_init_data(user, binary):
+    '''
+    Return the init payload for a new websocket, encoded as json text or
+    msgpack: the shared snapshot with this websocket's nonce and captcha
+    digest spliced in.
+    '''
+    snapshot = await get_init_snapshot()
+    own = {
+        'nonce': generate_nonce(),
+        'digest': get_random_captcha_digest_for(user),
+    }
+    if binary:
+        if snapshot['packed_items'] is None:
+            snapshot['packed_items'] = pack_map_items(snapshot['payload'])
+        data = splice_msgpack(
+            own,
+            len(snapshot['payload']),
+            snapshot['packed_items'],
+        )
+    else:
+        data = splice_json(own, snapshot['text'])
+    return data
+
+async def websocket_outbound(queue, user, binary=False, deflate=False):
     # This function does NOT check alllowedness at first, only later.
     # Allowedness is assumed to be checked beforehand (by the route handler).
     # These first two websocket messages are always sent.
     await websocket.send_json({'type': 'ping'})
-    await websocket.send_json({
-        'type': 'init',
-        'nonce': generate_nonce(),
-        'title': await get_stream_title(),
-        'stats': get_stream_uptime_and_viewership(for_websocket=True),
-        'messages': get_all_messages_for_websocket(),
-        'users': get_all_users_for_websocket(),
-        'default': {
-            True: CONFIG['DEFAULT_HOST_NAME'],
-            False: CONFIG['DEFAULT_ANON_NAME'],
-        },
-        'scrollback': CONFIG['MAX_CHAT_SCROLLBACK'],
-        'digest': get_random_captcha_digest_for(user),
-        'pingpong': CONFIG['TASK_BROADCAST_PING'],
-        'maxlength': {
-            'comment': CONFIG['CHAT_COMMENT_MAX_LENGTH'],
-            'name': CONFIG['CHAT_NAME_MAX_LENGTH'],
-            'password': CONFIG['CHAT_TRIPCODE_PASSWORD_MAX_LENGTH'],
-        },
-    })
+    if deflate:
+        # Text frames are never compressed, binary frames always are
+        deflater = Deflater(
+            CONFIG['SOCKET_WEBSOCKET_COMPRESSION_LEVEL'],
+            DEFLATE_DICTIONARY,
+            WEBSOCKET_COMPRESSION,
+        )
+        await websocket.send_json({
+            'type': 'deflate',
+            'dictionary': DEFLATE_DICTIONARY.decode(),
+        })
+        encode = deflater.compress
+    else:
+        encode = lambda data: data
+    await websocket.send(encode(await get_init_data(user, binary)))
     while True:
-        payload = await queue.get()
-        if payload['type'] == 'kick':
-            await websocket.send_json(payload)
-            await websocket.close(1001)
-            break
-        elif payload['type'] == 'close':
-            await websocket.close(1011)
-            break
-        else:
-            try:
-                ensure_allowedness(user)
-            except AllowednessException:
-                await websocket.send_json({'type': 'kick'})
+        # Take everything that's pending and skip superseded frames, so a
+        # client that fell behind catches up instead of falling further behind
+        frames = [await queue.get()]
+        while not queue.empty():
+            frames.append(queue.get_nowait())
+        for frame in coalesce_frames(frames):
+            if frame.type == 'kick':
+                await websocket.send(frame.text)
                 await websocket.close(1001)
-                break
+                return
+            elif frame.type == 'close':
+                await websocket.close(1011)
+                return
             else:
-                if user['verified'] is None:
+                try:
+                    ensure_allowedness(user)
+                except AllowednessException:
                     await websocket.send_json({'type': 'kick'})
                     await websocket.close(1001)
+                    return
                 else:
-                    await websocket.send_json(payload)
+                    if user['verified'] is None:
+                        await websocket.send_json({'type': 'kick'})
+                        await websocket.close(1001)
+                    else:
+                        await websocket.send(encode(frame.data(binary)))
 
 async def websocket_inbound(queue, user):
     while True:
@@ -103,11 +174,13 @@ async def websocket_inbound(queue, user):
                             handle = handle_inbound_captcha
                         case WS.PONG:
                             handle = handle_inbound_pong
+                        case WS.RESYNC:
+                            handle = handle_inbound_resync
                     payload = handle(timestamp, queue, user, *parsed)
 
         # Write to websocket
         if payload is not None:
-            queue.put_nowait(payload)
+            enqueue(user, queue, Frame(payload))
 
 def handle_inbound_pong(timestamp, queue, user):
     print(f'[pong] {identifying_string(user)}')
@@ -115,6 +188,12 @@ def handle_inbound_pong(timestamp, queue, user):
     user['websockets'][queue] = timestamp
     return None
 
+def handle_inbound_resync(timestamp, queue, user):
+    return {
+        'type': 'reset-users',
+        'users': get_all_users_for_websocket(),
+    }
+
 def handle_inbound_captcha(timestamp, queue, user):
     return {
         'type': 'captcha',